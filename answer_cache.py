@@ -0,0 +1,89 @@
+import os
+import copy
+import time
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# Answers kept in memory (0 disables the cache)
+ANSWER_CACHE_SIZE = int(os.getenv("RAG_ANSWER_CACHE_SIZE", 1024))
+# Seconds a cached answer stays valid
+ANSWER_CACHE_TTL = float(os.getenv("RAG_ANSWER_CACHE_TTL", 3600))
+# Cosine similarity a new question needs to reuse a cached answer
+ANSWER_CACHE_THRESHOLD = float(os.getenv("RAG_ANSWER_CACHE_THRESHOLD", 0.97))
+
+
+class AnswerCache:
+    """
+    Semantic cache of get_answer results.
+    An entry is reused when a new question's embedding is within the
+    similarity threshold of a cached one *and* both were asked in the same
+    scope: provider, visible-document set, index version and conversation. Entries expire
+    after `ttl` seconds and the least recently used ones are evicted first.
+    """
+
+    def __init__(self, max_items=ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL, threshold=ANSWER_CACHE_THRESHOLD):
+        self.max_items = max_items
+        self.ttl = ttl
+        self.threshold = threshold
+        # entry id -> (scope, unit query vector, result, created)
+        self._entries = OrderedDict()
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _unit(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def get(self, scope, query_vector):
+        """Returns a copy of the cached result closest to `query_vector` in `scope`, or None."""
+        if self.max_items <= 0:
+            return None
+        query_vector = self._unit(query_vector)
+        now = time.time()
+        with self._lock:
+            candidates = []
+            for entry_id, (entry_scope, vector, result, created) in list(self._entries.items()):
+                if now - created > self.ttl:
+                    del self._entries[entry_id]
+                elif entry_scope == scope:
+                    candidates.append((entry_id, vector))
+
+            if candidates:
+                similarities = np.stack([vector for _, vector in candidates]) @ query_vector
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    entry_id = candidates[best][0]
+                    self._entries.move_to_end(entry_id)
+                    self.hits += 1
+                    return copy.deepcopy(self._entries[entry_id][2])
+
+            self.misses += 1
+            return None
+
+    def put(self, scope, query_vector, result):
+        if self.max_items <= 0:
+            return
+        with self._lock:
+            self._entries[self._next_id] = (scope, self._unit(query_vector), copy.deepcopy(result), time.time())
+            self._next_id += 1
+            while len(self._entries) > self.max_items:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": float(round(self.hits / lookups, 4)) if lookups else 0.0,
+            "items": len(self._entries),
+        }
@@ -5,7 +5,7 @@ import shutil
 
 
 from rag_engine import RAGManager
-from database import init_db, add_message, get_chat_history
+from database import init_db, add_messages, get_chat_context
 
 # --- PAGE CONFIGURATION ---
 st.set_page_config(
@@ -17,12 +17,18 @@ st.set_page_config(
 
 # --- SYSTEM INITIALIZATION (Backend Setup inside Frontend) ---
 
-if "rag_manager" not in st.session_state:
-    st.session_state.rag_manager = RAGManager()
-    
-
+@st.cache_resource
+def get_rag_manager():
+    """
+    One engine per process, shared by every browser session, so the index,
+    caches and provider clients are loaded once rather than per session.
+    """
     init_db()
     os.makedirs("data", exist_ok=True)
+    return RAGManager()
+
+
+rag_manager = get_rag_manager()
 
 # --- SESSION STATE INITIALIZATION ---
 if "session_id" not in st.session_state:
@@ -120,7 +126,7 @@ with st.sidebar:
                     st.write("⚙️ Parsing and Embedding...")
                     
                     # Direct call instead of requests.post
-                    num_chunks = st.session_state.rag_manager.process_files(
+                    num_chunks = rag_manager.process_files(
                         file_paths=saved_paths,
                         username=username,
                         privacy=privacy_val,
@@ -199,21 +205,27 @@ if prompt := st.chat_input("Ask a question about your uploaded documents..."):
                 try:
                     # --- CORE LOGIC UPDATE (Replacing requests.post) ---
                     
-                    # 1. Get History (Direct DB Call)
-                    history = get_chat_history(st.session_state.session_id)
+                    # 1. Get History (Direct DB Call): recent turns + summary of older ones
+                    history, summary = get_chat_context(st.session_state.session_id)
                     
-                    # 2. Get Answer (Direct RAG Engine Call)
-                    result = st.session_state.rag_manager.get_answer(
+                    # 2. Stream Answer (Direct RAG Engine Call), rendering tokens as they arrive
+                    result = None
+                    for frame in rag_manager.stream_answer(
                         query=prompt,
                         history=history,
                         username=username,
                         provider=provider_key_type,
-                        api_key=api_key
-                    )
+                        api_key=api_key,
+                        history_summary=summary
+                    ):
+                        if frame["type"] == "token":
+                            full_response += frame["content"]
+                            message_placeholder.markdown(full_response + "▌")
+                        else:
+                            result = frame
                     
                     # 3. Save Conversation to DB (Direct DB Call)
-                    add_message(st.session_state.session_id, "user", prompt)
-                    add_message(st.session_state.session_id, "assistant", result["answer"])
+                    add_messages(st.session_state.session_id, [("user", prompt), ("assistant", result["answer"])])
                     
                     # --- DATA EXTRACTION ---
                     answer = result["answer"]
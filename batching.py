@@ -0,0 +1,74 @@
+import os
+import time
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from metrics import REGISTRY
+
+# Set RAG_MICRO_BATCHING=0 to embed and search every request on its own
+MICRO_BATCHING = os.getenv("RAG_MICRO_BATCHING", "1") == "1"
+# How long the first call of a batch waits for others to join
+BATCH_WAIT_MS = float(os.getenv("RAG_BATCH_WAIT_MS", 2))
+# Calls served by one batch at most
+BATCH_MAX_SIZE = int(os.getenv("RAG_BATCH_MAX_SIZE", 32))
+
+BATCH_SIZE = REGISTRY.histogram(
+    "rag_batch_size", "Calls served per micro-batch.", ("batcher",), buckets=(1, 2, 4, 8, 16, 32, 64, 128)
+)
+
+
+class MicroBatcher:
+    """
+    Merges calls made by concurrent request threads into batches.
+    submit(key, item) blocks until its result is ready. Calls arriving within
+    `max_wait` seconds of the first one (up to `max_batch`) form a batch;
+    calls with equal keys are then served together by one `fn(key, items)`,
+    which must return one result per item, in order.
+    Calls also pile up while a batch runs, so batches grow with load and a
+    lone request only pays `max_wait`.
+    """
+
+    def __init__(self, name, fn, max_batch=BATCH_MAX_SIZE, max_wait=BATCH_WAIT_MS / 1000, workers=4):
+        self.name = name
+        self.fn = fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        # Groups run here so the collector keeps gathering the next batch meanwhile
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"batch-{name}")
+        self._thread = threading.Thread(target=self._collect, name=f"batcher-{name}", daemon=True)
+        self._thread.start()
+
+    def submit(self, key, item):
+        future = Future()
+        self._queue.put((key, item, future))
+        return future.result()
+
+    def _collect(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.perf_counter()
+                try:
+                    batch.append(self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            groups = {}
+            for key, item, future in batch:
+                groups.setdefault(key, []).append((item, future))
+            for key, entries in groups.items():
+                self._executor.submit(self._run, key, entries)
+
+    def _run(self, key, entries):
+        BATCH_SIZE.observe(len(entries), batcher=self.name)
+        try:
+            results = self.fn(key, [item for item, _ in entries])
+        except Exception as e:
+            for _, future in entries:
+                future.set_exception(e)
+            return
+        for (_, future), result in zip(entries, results):
+            future.set_result(result)
@@ -0,0 +1,307 @@
+"""
+Offline performance benchmark for RAGManager.
+
+Runs entirely on provider="local" (hashing embedder + echo LLM), so it needs
+no API key and results are comparable between runs. Each corpus size is
+measured in a fresh process so peak RSS numbers don't leak between sizes.
+
+    python benchmark.py --sizes 1000,10000,100000 --output bench_results.json
+
+--chunking compares the chunker with the RecursiveCharacterTextSplitter it
+replaced, on the same corpus cut into PDF-like pages:
+
+    python benchmark.py --chunking --sizes 10000,100000 --output chunking_results.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import subprocess
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, ROOT)
+
+# Synthetic corpus shape: chunk-sized paragraphs drawn from a Zipf vocabulary
+VOCAB_SIZE = 20000
+WORDS_PER_CHUNK = 130   # ~900 characters, i.e. one splitter chunk
+CHUNKS_PER_FILE = 1000
+# Page length for --chunking; pages are cut mid-sentence, like PDF pages
+PAGE_CHARS = 3000
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process and of its (parse worker) children."""
+    scale = 1 if sys.platform == "darwin" else 1024   # ru_maxrss is bytes on macOS, KiB elsewhere
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+    return round(own / 2 ** 20, 1), round(children / 2 ** 20, 1)
+
+
+def percentiles(samples_s):
+    ms = np.asarray(samples_s) * 1000
+    return {f"p{p}": float(round(np.percentile(ms, p), 3)) for p in (50, 95, 99)}
+
+
+def make_corpus(corpus_dir, n_chunks, seed=0):
+    """Writes n_chunks chunk-sized paragraphs into text files and returns their paths."""
+    rng = np.random.default_rng(seed)
+    vocab = np.array([f"w{i:05d}" for i in range(VOCAB_SIZE)])
+    # Zipf-like word frequencies, like natural text
+    weights = 1.0 / np.arange(1, VOCAB_SIZE + 1)
+    weights /= weights.sum()
+
+    os.makedirs(corpus_dir, exist_ok=True)
+    paths = []
+    for file_no, start in enumerate(range(0, n_chunks, CHUNKS_PER_FILE)):
+        count = min(CHUNKS_PER_FILE, n_chunks - start)
+        words = vocab[rng.choice(VOCAB_SIZE, size=(count, WORDS_PER_CHUNK), p=weights)]
+        path = os.path.join(corpus_dir, f"doc_{file_no:05d}.txt")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("\n\n".join(" ".join(row) for row in words))
+        paths.append(path)
+    return paths
+
+
+def make_queries(paths, n_queries, seed=1):
+    """Questions built from words of random paragraphs, so every query has real hits."""
+    rng = np.random.default_rng(seed)
+    queries = []
+    for _ in range(n_queries):
+        with open(paths[rng.integers(len(paths))], "r", encoding="utf-8") as f:
+            paragraphs = f.read().split("\n\n")
+        words = paragraphs[rng.integers(len(paragraphs))].split()
+        picks = rng.choice(len(words), size=min(6, len(words)), replace=False)
+        queries.append("what about " + " ".join(words[i] for i in sorted(picks)))
+    return queries
+
+
+def run_one(n_chunks, args):
+    """Benchmarks one corpus size in the current process and returns a result dict."""
+    import faiss
+    import parsing
+    import rag_engine
+    from rag_engine import RAGManager
+    from vector_store import build_index, resolve_index_type, MMAP_FLAGS
+
+    work_dir = os.path.join(args.workdir, f"n{n_chunks}")
+    shutil.rmtree(work_dir, ignore_errors=True)
+    os.makedirs(work_dir)
+    os.chdir(work_dir)   # keeps the embedding cache / chat DB files out of the repo
+    rag_engine.DB_PATH = os.path.join(work_dir, "db")
+    result = {"chunks": n_chunks, "index_type": args.index_type or "auto"}
+
+    start = time.perf_counter()
+    paths = make_corpus(os.path.join(work_dir, "corpus"), n_chunks)
+    result["corpus_s"] = round(time.perf_counter() - start, 3)
+
+    # --- INGESTION ---
+    # Spawned workers are children of this process (fork server ones are not), so RUSAGE_CHILDREN sees them
+    parsing.PARSE_START_METHOD = "spawn"
+    manager = RAGManager(index_type=args.index_type)
+    start = time.perf_counter()
+    ingested = manager.process_files(paths, "bench", "public", "local", "local")
+    ingest_s = time.perf_counter() - start
+    result.update(
+        ingested_chunks=ingested,
+        ingest_s=round(ingest_s, 3),
+        ingest_chunks_per_s=round(ingested / ingest_s, 1),
+    )
+    # Parse workers are long-lived; their peak only shows once they have exited
+    parsing.shutdown_pools()
+    result["peak_rss_mb_after_ingest"], result["peak_rss_mb_parse_workers"] = peak_rss_mb()
+
+    # --- INDEX BUILD / SAVE / LOAD ---
+    store = manager.vector_store
+    vectors = np.concatenate([seg.get_vectors(np.arange(len(seg.ids))) for seg in store.segments if seg.index is not None])
+    built_type = resolve_index_type(len(vectors), args.index_type)
+    start = time.perf_counter()
+    index = build_index(vectors, built_type)
+    result["index_build_s"] = round(time.perf_counter() - start, 3)
+    result["index_built_type"] = built_type
+
+    index_path = os.path.join(work_dir, "bench_index.faiss")
+    start = time.perf_counter()
+    faiss.write_index(index, index_path)
+    result["index_save_s"] = round(time.perf_counter() - start, 3)
+    start = time.perf_counter()
+    faiss.read_index(index_path, MMAP_FLAGS)
+    result["index_load_mmap_s"] = round(time.perf_counter() - start, 4)
+    start = time.perf_counter()
+    faiss.read_index(index_path)
+    result["index_load_s"] = round(time.perf_counter() - start, 3)
+    result["index_bytes"] = os.path.getsize(index_path)
+    del index, vectors
+
+    # --- QUERIES (fresh manager = cold start from disk) ---
+    manager = RAGManager(index_type=args.index_type)
+    manager.answer_cache.max_items = 0   # measure the full pipeline every time
+    queries = make_queries(paths, args.queries + 1)
+
+    start = time.perf_counter()
+    manager.get_answer(queries[0], [], "bench", "local", "local")
+    result["cold_first_answer_ms"] = round((time.perf_counter() - start) * 1000, 3)
+    result["store_segments"] = len(manager.vector_store.segments)
+
+    answer_s, search_s = [], []
+    with manager._get_embeddings("local", "local") as embeddings:
+        for query in queries[1:]:
+            start = time.perf_counter()
+            manager.get_answer(query, [], "bench", "local", "local")
+            answer_s.append(time.perf_counter() - start)
+
+            query_matrix = manager._embed_queries([query], embeddings, "local")
+            start = time.perf_counter()
+            manager.vector_store.search(query_matrix, "bench", k=4)
+            search_s.append(time.perf_counter() - start)
+
+    result["get_answer_ms"] = percentiles(answer_s)
+    result["search_ms"] = percentiles(search_s)
+    result["peak_rss_mb"], _ = peak_rss_mb()
+    return result
+
+
+def make_pages(paths):
+    """Every corpus file as a list of PAGE_CHARS-long page Documents."""
+    from langchain_classic.schema import Document
+    files = []
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            text = f.read()
+        files.append([
+            Document(page_content=text[start:start + PAGE_CHARS], metadata={"source": path, "page": page})
+            for page, start in enumerate(range(0, len(text), PAGE_CHARS))
+        ])
+    return files
+
+
+def run_chunking(n_chunks, args):
+    """Throughput and chunk shape of the old and new splitters on one corpus size."""
+    from concurrent.futures import ProcessPoolExecutor
+    from langchain_classic.text_splitter import RecursiveCharacterTextSplitter
+    from chunking import split_documents, CHUNK_SIZE_TOKENS, CHUNK_OVERLAP_TOKENS
+    from parsing import PARSE_WORKERS
+    from prompt_builder import count_tokens
+
+    work_dir = os.path.join(args.workdir, f"chunking_n{n_chunks}")
+    shutil.rmtree(work_dir, ignore_errors=True)
+    files = make_pages(make_corpus(os.path.join(work_dir, "corpus"), n_chunks))
+    megabytes = sum(len(doc.page_content) for pages in files for doc in pages) / 2 ** 20
+    result = {"chunks": n_chunks, "pages": sum(len(pages) for pages in files), "corpus_mb": round(megabytes, 2)}
+    count_tokens("warm up")   # loads the tokenizer outside the timings
+
+    def measure(name, split):
+        start = time.perf_counter()
+        chunks = split()
+        elapsed = time.perf_counter() - start
+        sizes = np.array([count_tokens(chunk.page_content) for chunk in chunks])
+        result[name] = {
+            "s": round(elapsed, 3),
+            "mb_per_s": round(megabytes / elapsed, 2),
+            "chunks": len(chunks),
+            "tokens_p50": int(np.percentile(sizes, 50)),
+            "tokens_max": int(sizes.max()),
+            # Page-boundary leftovers and other runts
+            "fragments": int((sizes < CHUNK_SIZE_TOKENS // 4).sum()),
+        }
+
+    pages = [doc for file_pages in files for doc in file_pages]
+    splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
+    measure("recursive_character", lambda: splitter.split_documents(pages))
+    # The same splitter measuring tokens instead of characters
+    splitter = RecursiveCharacterTextSplitter(
+        chunk_size=CHUNK_SIZE_TOKENS, chunk_overlap=CHUNK_OVERLAP_TOKENS, length_function=count_tokens
+    )
+    measure("recursive_token", lambda: splitter.split_documents(pages))
+    measure("token_serial", lambda: [chunk for pages in files for chunk in split_documents(pages)])
+    with ProcessPoolExecutor(max_workers=PARSE_WORKERS) as executor:
+        # Start the workers first: the pool is long-lived during real ingestion
+        list(executor.map(count_tokens, ["warm up"] * PARSE_WORKERS))
+        measure("token_parallel", lambda: [chunk for chunks in executor.map(split_documents, files) for chunk in chunks])
+    result["token_parallel"]["workers"] = PARSE_WORKERS
+    for baseline in ("recursive_character", "recursive_token"):
+        result[f"speedup_vs_{baseline}"] = round(result[baseline]["s"] / result["token_parallel"]["s"], 2)
+    shutil.rmtree(work_dir, ignore_errors=True)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline RAGManager benchmark (provider=local).")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="Comma-separated corpus sizes in chunks (up to 1000000)")
+    parser.add_argument("--queries", type=int, default=200, help="get_answer calls timed per size")
+    parser.add_argument("--index-type", default=None, help="flat / ivf / hnsw / ivfpq / auto")
+    parser.add_argument("--workdir", default=os.path.join(ROOT, "bench_work"), help="Scratch folder (deleted per size)")
+    parser.add_argument("--output", default="bench_results.json", help="JSON file the results are written to")
+    parser.add_argument("--embed-latency", type=float, default=None, help="Simulated seconds per embedding call")
+    parser.add_argument("--llm-latency", type=float, default=None, help="Simulated seconds before the first LLM token")
+    parser.add_argument("--keep", action="store_true", help="Keep the scratch folder afterwards")
+    parser.add_argument("--chunking", action="store_true", help="Benchmark the chunker against RecursiveCharacterTextSplitter")
+    parser.add_argument("--one", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.workdir = os.path.abspath(args.workdir)
+
+    if args.one:
+        print(json.dumps(run_one(args.one, args)))
+        return
+
+    if args.chunking:
+        results = []
+        for size in [int(s) for s in args.sizes.split(",") if s.strip()]:
+            print(f"⏱️ Chunking {size} chunks worth of text...")
+            result = run_chunking(size, args)
+            print(json.dumps(result, indent=2))
+            results.append(result)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "cpu_count": os.cpu_count(), "results": results}, f, indent=2)
+        print(f"✅ Results saved to {args.output}")
+        return
+
+    env = dict(os.environ)
+    if args.embed_latency is not None:
+        env["RAG_LOCAL_EMBED_LATENCY"] = str(args.embed_latency)
+    if args.llm_latency is not None:
+        env["RAG_LOCAL_LLM_LATENCY"] = str(args.llm_latency)
+
+    results = []
+    for size in [int(s) for s in args.sizes.split(",") if s.strip()]:
+        print(f"⏱️ Benchmarking {size} chunks...")
+        cmd = [sys.executable, os.path.abspath(__file__), "--one", str(size), "--queries", str(args.queries), "--workdir", args.workdir]
+        if args.index_type:
+            cmd += ["--index-type", args.index_type]
+        proc = subprocess.run(cmd, env=env, capture_output=True, text=True)
+        if proc.returncode != 0:
+            print(f"❌ Size {size} failed:\n{proc.stderr[-2000:]}")
+            results.append({"chunks": size, "error": proc.stderr[-2000:]})
+            continue
+        # Progress lines are printed too; the result is the last JSON line
+        result = json.loads([line for line in proc.stdout.splitlines() if line.startswith("{")][-1])
+        print(json.dumps(result, indent=2))
+        results.append(result)
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "settings": {
+            "queries": args.queries,
+            "index_type": args.index_type or "auto",
+            "embed_latency": env.get("RAG_LOCAL_EMBED_LATENCY", "0"),
+            "llm_latency": env.get("RAG_LOCAL_LLM_LATENCY", "0"),
+        },
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    if not args.keep:
+        shutil.rmtree(args.workdir, ignore_errors=True)
+    print(f"✅ Results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
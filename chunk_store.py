@@ -0,0 +1,207 @@
+import re
+import json
+import math
+import sqlite3
+import threading
+from collections import Counter
+
+from langchain_classic.schema import Document
+
+# File inside the database folder holding chunk text and metadata
+CHUNKS_FILE = "chunks.db"
+# SQLite caps the number of bound parameters per statement
+LOOKUP_BATCH = 500
+
+# Words ignored by lexical search and query expansion
+STOPWORDS = frozenset("""
+a about above after again all am an and any are as at be because been before being below between both but by
+can could did do does doing down during each few for from further had has have having he her here hers him his
+how i if in into is it its itself just me more most my no nor not now of off on once only or other our ours out
+over own same she should so some such than that the their theirs them then there these they this those through
+to too under until up very was we were what when where which while who whom why will with would you your yours
+tell explain describe give list show please
+""".split())
+_WORD = re.compile(r"\w+")
+
+
+def lexical_terms(text):
+    """Lower-cased content words of `text`, in order, without stopwords or duplicates."""
+    words = (w for w in _WORD.findall(text.lower()) if w not in STOPWORDS and len(w) > 1)
+    return list(dict.fromkeys(words))
+
+
+class ChunkStore:
+    """
+    Chunk text and metadata in an indexed SQLite table keyed by vector id.
+    The FAISS segments only hold vectors; search hits are resolved here with
+    one batched lookup, and metadata (who uploaded what, which chunks are
+    public) can be queried without loading any index.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._get_conn()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS chunks (
+                vector_id INTEGER PRIMARY KEY,
+                source TEXT,
+                owner TEXT,
+                privacy TEXT,
+                content TEXT,
+                metadata TEXT
+            )
+        ''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_chunks_owner ON chunks (owner, privacy)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_chunks_privacy ON chunks (privacy)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_chunks_source ON chunks (source)")
+
+        # Full-text (BM25) index over the chunk text, kept in sync by triggers
+        has_fts = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'chunks_fts'").fetchone()
+        conn.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts USING fts5(content, content='chunks', content_rowid='vector_id')"
+        )
+        conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS chunks_vocab USING fts5vocab(chunks_fts, 'row')")
+        conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS chunks_ai AFTER INSERT ON chunks BEGIN
+                INSERT INTO chunks_fts (rowid, content) VALUES (new.vector_id, new.content);
+            END
+        ''')
+        conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS chunks_ad AFTER DELETE ON chunks BEGIN
+                INSERT INTO chunks_fts (chunks_fts, rowid, content) VALUES ('delete', old.vector_id, old.content);
+            END
+        ''')
+        if not has_fts:
+            # Chunk stores written before the full-text index existed
+            conn.execute("INSERT INTO chunks_fts (chunks_fts) VALUES ('rebuild')")
+        conn.commit()
+        self._row_count = None
+
+    def _get_conn(self):
+        # One connection per thread; WAL lets searches read while ingestion writes
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            # REPLACE must fire the delete trigger that keeps the full-text index in sync
+            conn.execute("PRAGMA recursive_triggers=ON")
+            self._local.conn = conn
+        return conn
+
+    def add(self, vector_ids, docs):
+        """Stores `docs` under `vector_ids` in a single transaction."""
+        conn = self._get_conn()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO chunks (vector_id, source, owner, privacy, content, metadata) VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    (
+                        int(vector_id),
+                        doc.metadata.get("source"),
+                        doc.metadata.get("owner", "unknown"),
+                        doc.metadata.get("privacy", "private"),
+                        doc.page_content,
+                        json.dumps(doc.metadata),
+                    )
+                    for vector_id, doc in zip(vector_ids, docs)
+                )
+            )
+        self._row_count = None
+
+    def get(self, vector_ids):
+        """Returns {vector_id: Document} for the ids that exist."""
+        vector_ids = [int(v) for v in vector_ids]
+        conn = self._get_conn()
+        docs = {}
+        for start in range(0, len(vector_ids), LOOKUP_BATCH):
+            batch = vector_ids[start:start + LOOKUP_BATCH]
+            rows = conn.execute(
+                f"SELECT vector_id, content, metadata FROM chunks WHERE vector_id IN ({','.join('?' * len(batch))})",
+                batch
+            )
+            for vector_id, content, metadata in rows:
+                docs[vector_id] = Document(page_content=content, metadata=json.loads(metadata))
+        return docs
+
+    def delete(self, vector_ids):
+        vector_ids = [(int(v),) for v in vector_ids]
+        conn = self._get_conn()
+        with conn:
+            conn.executemany("DELETE FROM chunks WHERE vector_id = ?", vector_ids)
+        self._row_count = None
+
+    def delete_from(self, vector_id):
+        """Drops rows with ids >= vector_id (left behind by an unpublished ingestion)."""
+        conn = self._get_conn()
+        with conn:
+            conn.execute("DELETE FROM chunks WHERE vector_id >= ?", (int(vector_id),))
+        self._row_count = None
+
+    @staticmethod
+    def _where(**filters):
+        clauses = [f"{column} = ?" for column, value in filters.items() if value is not None]
+        params = [value for value in filters.values() if value is not None]
+        return (f"WHERE {' AND '.join(clauses)}" if clauses else ""), params
+
+    def query(self, owner=None, privacy=None, source=None, limit=100):
+        """
+        Returns chunk metadata rows (no text) matching the given filters,
+        e.g. query(owner="alice") or query(privacy="public").
+        """
+        where, params = self._where(owner=owner, privacy=privacy, source=source)
+        rows = self._get_conn().execute(
+            f"SELECT vector_id, metadata FROM chunks {where} ORDER BY vector_id LIMIT ?",
+            params + [limit]
+        )
+        return [dict(json.loads(metadata), vector_id=vector_id) for vector_id, metadata in rows]
+
+    def count(self, owner=None, privacy=None, source=None):
+        where, params = self._where(owner=owner, privacy=privacy, source=source)
+        return self._get_conn().execute(f"SELECT COUNT(*) FROM chunks {where}", params).fetchone()[0]
+
+    # --- LEXICAL SEARCH ---
+    def lexical_search(self, text, username, limit=10):
+        """
+        BM25 full-text search over the chunks `username` may see (their own
+        plus public ones). Returns [(vector_id, score)], best first.
+        """
+        terms = lexical_terms(text)
+        if not terms:
+            return []
+        match = " OR ".join(f'"{term}"' for term in terms)
+        rows = self._get_conn().execute('''
+            SELECT chunks.vector_id, bm25(chunks_fts) AS score
+            FROM chunks_fts JOIN chunks ON chunks.vector_id = chunks_fts.rowid
+            WHERE chunks_fts MATCH ? AND (chunks.privacy = 'public' OR chunks.owner = ?)
+            ORDER BY score LIMIT ?
+        ''', (match, username, limit))
+        # SQLite's bm25() is negative, lower = better
+        return [(vector_id, -score) for vector_id, score in rows]
+
+    def expansion_terms(self, text, feedback_ids, n_terms=2, min_docs=2):
+        """
+        Pseudo-relevance feedback: the words that co-occur most often with the
+        query in the chunks `feedback_ids` (typically its top lexical hits),
+        weighted by IDF so words common across the whole corpus don't win.
+        """
+        query_terms = set(lexical_terms(text))
+        in_docs = Counter()
+        for doc in self.get(feedback_ids).values():
+            in_docs.update(t for t in lexical_terms(doc.page_content) if t not in query_terms and not t.isdigit())
+        candidates = [term for term, count in in_docs.most_common(30) if count >= min_docs]
+        if not candidates:
+            return []
+
+        if self._row_count is None:
+            self._row_count = self.count()
+        n = max(self._row_count, 1)
+        df = dict(self._get_conn().execute(
+            f"SELECT term, doc FROM chunks_vocab WHERE term IN ({','.join('?' * len(candidates))})", candidates
+        ))
+
+        def idf(term):
+            return math.log(1 + (n - df.get(term, 0) + 0.5) / (df.get(term, 0) + 0.5))
+
+        return sorted(candidates, key=lambda t: in_docs[t] * idf(t), reverse=True)[:n_terms]
@@ -0,0 +1,90 @@
+import os
+import re
+from bisect import bisect_right
+
+import numpy as np
+from langchain_classic.schema import Document
+
+from prompt_builder import token_offsets
+
+# Tokens per chunk at most (~1000 characters of English text)
+CHUNK_SIZE_TOKENS = int(os.getenv("RAG_CHUNK_SIZE_TOKENS", 250))
+# Tokens repeated at the start of the next chunk
+CHUNK_OVERLAP_TOKENS = int(os.getenv("RAG_CHUNK_OVERLAP_TOKENS", 50))
+# Pages of a file are joined with this before chunking, so text flows across page breaks
+PAGE_SEPARATOR = "\n"
+# Where a chunk may end, best first: paragraph, line, sentence, word
+BREAKS = (("\n\n",), ("\n",), (". ", "? ", "! "), (" ",))
+
+_SPACE = re.compile(r"\s")
+
+
+def chunk_spans(text, offsets, size=CHUNK_SIZE_TOKENS, overlap=CHUNK_OVERLAP_TOKENS):
+    """
+    (start, end) character spans of the chunks of `text`, given the start
+    offset of each of its tokens. A chunk holds at most `size` tokens and
+    ends at the best break found in its second half.
+    """
+    spans = []
+    n = len(offsets)
+    first = 0
+    while first < n:
+        start = int(offsets[first])
+        if first + size >= n:
+            spans.append((start, len(text)))
+            break
+        lo, hi = int(offsets[first + size // 2]), int(offsets[first + size])
+        end, level = hi, len(BREAKS)
+        for level, separators in enumerate(BREAKS):
+            ends = [i + len(sep) for sep in separators for i in (text.rfind(sep, lo, hi),) if i != -1]
+            if ends:
+                end = max(ends)
+                break
+        spans.append((start, end))
+
+        # First token of the next chunk: `overlap` tokens back (none after a
+        # paragraph break), moved up to a word start
+        last = int(np.searchsorted(offsets, end))
+        following = max(last - (overlap if level else 0), first + 1)
+        if following < last:
+            space = _SPACE.search(text, int(offsets[following]), end)
+            if space:
+                following = max(following, int(np.searchsorted(offsets, space.start())))
+        first = following
+    return spans
+
+
+def split_documents(docs):
+    """
+    Chunks a file's Documents (one per PDF page) as one continuous text, so
+    a chunk can run across a page break instead of leaving a fragment on
+    each side. Chunks are single slices of the joined text. Each keeps the
+    metadata of the page it starts on plus its provenance: `page_end` (for
+    paged files) and `start_index` / `end_index`, character offsets within
+    the first and last page.
+    """
+    if not docs:
+        return []
+    text = PAGE_SEPARATOR.join(doc.page_content for doc in docs)
+    page_starts = []
+    position = 0
+    for doc in docs:
+        page_starts.append(position)
+        position += len(doc.page_content) + len(PAGE_SEPARATOR)
+
+    chunks = []
+    for start, end in chunk_spans(text, token_offsets(text)):
+        content = text[start:end].strip()
+        if not content:
+            continue
+        start = text.index(content[0], start)
+        end = start + len(content)
+        first = bisect_right(page_starts, start) - 1
+        last = bisect_right(page_starts, end - 1) - 1
+        metadata = dict(docs[first].metadata)
+        if "page" in metadata:
+            metadata["page_end"] = docs[last].metadata.get("page")
+        metadata["start_index"] = start - page_starts[first]
+        metadata["end_index"] = end - page_starts[last]
+        chunks.append(Document(page_content=content, metadata=metadata))
+    return chunks
@@ -0,0 +1,133 @@
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import httpx
+
+# Provider clients kept alive at once
+CLIENT_POOL_SIZE = int(os.getenv("RAG_CLIENT_POOL_SIZE", 32))
+# Clients unused for this many seconds are closed
+CLIENT_IDLE_TIMEOUT = float(os.getenv("RAG_CLIENT_IDLE_TIMEOUT", 600))
+# Keep-alive HTTP pool of each OpenAI client
+HTTP_MAX_CONNECTIONS = int(os.getenv("RAG_HTTP_MAX_CONNECTIONS", 20))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("RAG_HTTP_KEEPALIVE_EXPIRY", 60))
+HTTP_TIMEOUT = float(os.getenv("RAG_HTTP_TIMEOUT", 120))
+# Point providers at another endpoint, e.g. a local stub server in tests
+OPENAI_BASE_URL = os.getenv("RAG_OPENAI_BASE_URL") or None
+GEMINI_BASE_URL = os.getenv("RAG_GEMINI_BASE_URL") or None
+
+
+def hash_api_key(api_key):
+    """Pool keys hold a digest of the API key, never the key itself."""
+    return hashlib.sha256(str(api_key).encode("utf-8")).hexdigest()[:16]
+
+
+def make_http_client():
+    """httpx client whose connections (and TLS sessions) are reused across requests."""
+    return httpx.Client(
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_CONNECTIONS,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+        timeout=HTTP_TIMEOUT,
+    )
+
+
+class ClientPool:
+    """
+    Registry of long-lived provider clients.
+    `lease(key, factory)` is a context manager giving the client stored under
+    `key`, built with `factory()` on first use. factory returns (client,
+    resources) where resources (e.g. httpx clients) are closed when the
+    entry is evicted. The pool is bounded (LRU) and drops clients idle for
+    `idle_timeout`; an entry is only closed once every lease on it has
+    ended, so a request never sees its client closed mid-call.
+    """
+
+    def __init__(self, max_clients=CLIENT_POOL_SIZE, idle_timeout=CLIENT_IDLE_TIMEOUT):
+        self.max_clients = max_clients
+        self.idle_timeout = idle_timeout
+        # key -> entry dict (client, resources, last_used, users, evicted)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+        self.evicted = 0
+
+    def _close(self, resources):
+        for resource in resources:
+            try:
+                resource.close()
+            except Exception as e:
+                print(f"⚠️ Error closing provider client: {e}")
+
+    def _evict(self, key, closing):
+        """Drops `key` from the pool; its resources go to `closing` unless it is still leased."""
+        entry = self._entries.pop(key)
+        entry["evicted"] = True
+        self.evicted += 1
+        if not entry["users"]:
+            closing.append(entry["resources"])
+
+    def _acquire(self, key, factory):
+        now = time.time()
+        closing = []
+        with self._lock:
+            # Leased entries are in use, not idle
+            for old_key, old in list(self._entries.items()):
+                if not old["users"] and now - old["last_used"] > self.idle_timeout:
+                    self._evict(old_key, closing)
+
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.reused += 1
+            else:
+                client, resources = factory()
+                entry = {"client": client, "resources": resources, "last_used": now, "users": 0, "evicted": False}
+                self._entries[key] = entry
+                self.created += 1
+                # Least recently used first; leased ones are closed when their last lease ends
+                while len(self._entries) > self.max_clients:
+                    self._evict(next(iter(self._entries)), closing)
+            entry["users"] += 1
+            entry["last_used"] = now
+
+        for resources in closing:
+            self._close(resources)
+        return entry
+
+    def _release(self, entry):
+        with self._lock:
+            entry["users"] -= 1
+            entry["last_used"] = time.time()
+            close = entry["evicted"] and not entry["users"]
+        if close:
+            self._close(entry["resources"])
+
+    @contextmanager
+    def lease(self, key, factory):
+        entry = self._acquire(key, factory)
+        try:
+            yield entry["client"]
+        finally:
+            self._release(entry)
+
+    def close(self):
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+        for entry in entries:
+            self._close(entry["resources"])
+
+    def stats(self):
+        return {
+            "clients": len(self._entries),
+            "created": self.created,
+            "reused": self.reused,
+            "evicted": self.evicted,
+        }
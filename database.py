@@ -1,41 +1,200 @@
 # backend/database.py
+import os
 import sqlite3
 import json
+import time
+import threading
 from datetime import datetime
 
+from prompt_builder import fold_history
+
 DB_NAME = "chat_memory.db"
+# Messages older than this many days are moved to the archive (0 = keep forever)
+RETENTION_DAYS = int(os.getenv("CHAT_RETENTION_DAYS", 0))
+# Archived messages are kept in a separate file so the live table stays small
+ARCHIVE_DB_NAME = os.getenv("CHAT_ARCHIVE_DB", "chat_archive.db")
+# Rows moved per transaction while archiving
+ARCHIVE_BATCH = 5000
+# Seconds between archiving runs while the server is up
+ARCHIVE_INTERVAL = float(os.getenv("CHAT_ARCHIVE_INTERVAL", 3600))
+# Unsummarized messages read per request at most (older ones are only in the summary)
+HISTORY_FETCH_LIMIT = 50
+
+_local = threading.local()
+# monotonic time of the next archiving run, claimed under the lock
+_next_archive = 0.0
+_archive_lock = threading.Lock()
+
+
+def _get_conn():
+    """Returns this thread's connection, opening it on first use."""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_NAME, timeout=30)
+        # WAL: readers never block the writer and commits don't rewrite the main file
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _local.conn = conn
+    return conn
+
 
 def init_db():
     """Initializes the SQLite database for chat history."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS chat_history (
-            session_id TEXT,
-            role TEXT,
-            content TEXT,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    conn.commit()
-    conn.close()
+    conn = _get_conn()
+    with conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS chat_history (
+                session_id TEXT,
+                role TEXT,
+                content TEXT,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        # History lookups read the newest rows of one session straight off this index:
+        # SQLite keeps the entries of each session_id in rowid order, so `rowid > after_id`
+        # is a range seek and the fetch costs O(limit) however long the session is
+        conn.execute("DROP INDEX IF EXISTS idx_chat_session_time")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_session ON chat_history (session_id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_time ON chat_history (timestamp)")
+        # Rolling summary of each session's older turns; last_id is the newest message it covers
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS chat_summary (
+                session_id TEXT PRIMARY KEY,
+                summary TEXT,
+                last_id INTEGER,
+                updated DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+    if RETENTION_DAYS > 0 and _claim_archive_run():
+        archive_old_messages(RETENTION_DAYS)
+
 
 def add_message(session_id, role, content):
     """Adds a single message to the database."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("INSERT INTO chat_history (session_id, role, content) VALUES (?, ?, ?)", 
-                   (session_id, role, content))
-    conn.commit()
-    conn.close()
-
-def get_chat_history(session_id, limit=10):
-    """Retrieves the last N messages for context."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT role, content FROM chat_history WHERE session_id = ? ORDER BY timestamp DESC LIMIT ?", 
-                   (session_id, limit))
-    rows = cursor.fetchall()
-    conn.close()
+    add_messages(session_id, [(role, content)])
+
+
+def add_messages(session_id, messages):
+    """Adds several (role, content) messages, e.g. a user/assistant pair, in one transaction."""
+    conn = _get_conn()
+    with conn:
+        conn.executemany(
+            "INSERT INTO chat_history (session_id, role, content) VALUES (?, ?, ?)",
+            [(session_id, role, content) for role, content in messages]
+        )
+    # Messages keep ageing while the server runs, not only between restarts
+    if RETENTION_DAYS > 0 and _claim_archive_run():
+        threading.Thread(target=_archive_in_background, daemon=True).start()
+
+
+def _claim_archive_run():
+    """True for the one caller that should archive now (at most once per ARCHIVE_INTERVAL)."""
+    global _next_archive
+    with _archive_lock:
+        now = time.monotonic()
+        if now < _next_archive:
+            return False
+        _next_archive = now + ARCHIVE_INTERVAL
+        return True
+
+
+def _archive_in_background():
+    try:
+        archive_old_messages(RETENTION_DAYS)
+    except Exception as e:
+        print(f"⚠️ Archiving chat messages failed: {e}")
+
+
+def get_chat_history(session_id, limit=10, after_id=None):
+    """Retrieves the last N messages for context (only those newer than `after_id` if given)."""
+    # rowid follows insertion order, so the newest messages are the highest rowids
+    rows = _get_conn().execute(
+        "SELECT rowid, role, content FROM chat_history WHERE session_id = ? AND rowid > ? "
+        "ORDER BY rowid DESC LIMIT ?",
+        (session_id, after_id or 0, limit)
+    ).fetchall()
     # Return in reverse order (oldest to newest) for LLM context
-    return [{"role": r[0], "content": r[1]} for r in rows][::-1]
+    return [{"id": r[0], "role": r[1], "content": r[2]} for r in rows][::-1]
+
+
+def get_summary(session_id):
+    """Returns (summary, last_id) of the session's folded turns, or ("", 0)."""
+    row = _get_conn().execute(
+        "SELECT summary, last_id FROM chat_summary WHERE session_id = ?", (session_id,)
+    ).fetchone()
+    return (row[0], row[1]) if row else ("", 0)
+
+
+def save_summary(session_id, summary, last_id):
+    conn = _get_conn()
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO chat_summary (session_id, summary, last_id, updated) VALUES (?, ?, ?, CURRENT_TIMESTAMP)",
+            (session_id, summary, last_id)
+        )
+
+
+def get_chat_context(session_id):
+    """
+    History for the next prompt as (recent_messages, summary).
+    Messages that no longer fit the history token budget are folded into
+    the session's stored summary once, so they are never re-read or resent.
+    """
+    summary, last_id = get_summary(session_id)
+    history = get_chat_history(session_id, limit=HISTORY_FETCH_LIMIT, after_id=last_id)
+    summary, recent, folded = fold_history(history, summary)
+    if folded:
+        save_summary(session_id, summary, folded[-1]["id"])
+    return recent, summary
+
+
+def archive_old_messages(days=RETENTION_DAYS, archive_db=ARCHIVE_DB_NAME):
+    """
+    Moves messages older than `days` into the archive database.
+    Works in batches of ARCHIVE_BATCH rows so chat requests are never blocked
+    for long. Pass archive_db=None to delete instead of archiving.
+    Returns the number of rows moved.
+    """
+    conn = _get_conn()
+    cutoff = f"-{int(days)} days"
+    moved = 0
+
+    if archive_db:
+        conn.execute("ATTACH DATABASE ? AS archive", (archive_db,))
+    try:
+        if archive_db:
+            with conn:
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS archive.chat_history (
+                        session_id TEXT,
+                        role TEXT,
+                        content TEXT,
+                        timestamp DATETIME
+                    )
+                ''')
+                conn.execute("CREATE INDEX IF NOT EXISTS archive.idx_archive_session_time ON chat_history (session_id, timestamp)")
+
+        while True:
+            with conn:
+                rowids = [r[0] for r in conn.execute(
+                    "SELECT rowid FROM main.chat_history WHERE timestamp < datetime('now', ?) LIMIT ?",
+                    (cutoff, ARCHIVE_BATCH)
+                )]
+                if not rowids:
+                    break
+                placeholders = ",".join("?" * len(rowids))
+                if archive_db:
+                    conn.execute(
+                        f"INSERT INTO archive.chat_history SELECT session_id, role, content, timestamp "
+                        f"FROM main.chat_history WHERE rowid IN ({placeholders})",
+                        rowids
+                    )
+                conn.execute(f"DELETE FROM main.chat_history WHERE rowid IN ({placeholders})", rowids)
+            moved += len(rowids)
+    finally:
+        if archive_db:
+            conn.execute("DETACH DATABASE archive")
+
+    if moved:
+        print(f"🗄️ Archived {moved} chat messages older than {days} days.")
+    return moved
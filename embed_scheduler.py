@@ -0,0 +1,324 @@
+import os
+import time
+import random
+import sqlite3
+import threading
+from collections import deque
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+
+from metrics import REGISTRY, NULL_TIMINGS
+from prompt_builder import count_tokens
+
+# Chunks per provider call when an ingestion starts; adapted while it runs
+EMBED_BATCH_SIZE = int(os.getenv("RAG_EMBED_BATCH_SIZE", 64))
+# Bounds of the adaptive batch size, and how much each successful call adds to it
+EMBED_MIN_BATCH = 1
+EMBED_MAX_BATCH = int(os.getenv("RAG_EMBED_MAX_BATCH", 512))
+EMBED_BATCH_STEP = 16
+# Tokens one call may carry at most (OpenAI rejects requests over 300k)
+EMBED_MAX_BATCH_TOKENS = int(os.getenv("RAG_EMBED_MAX_BATCH_TOKENS", 100000))
+# Provider calls in flight at once during ingestion
+EMBED_CONCURRENCY = int(os.getenv("RAG_EMBED_CONCURRENCY", 4))
+# Requests and tokens per minute allowed per provider (0 = unlimited). The
+# defaults are OpenAI / Gemini tier 1; RAG_EMBED_RPM / RAG_EMBED_TPM override them.
+EMBED_RATE_LIMITS = {
+    "openai": (3000, 1000000),
+    "gemini": (3000, 1000000),
+    "local": (0, 0),
+}
+EMBED_RPM = os.getenv("RAG_EMBED_RPM")
+EMBED_TPM = os.getenv("RAG_EMBED_TPM")
+# Seconds of budget that may be spent in one burst
+RATE_BURST_SECONDS = 10
+# Attempts per batch before the ingestion fails, and the backoff between them
+EMBED_MAX_RETRIES = int(os.getenv("RAG_EMBED_MAX_RETRIES", 6))
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 60.0
+# File inside the database folder holding vectors of unfinished ingestions
+CHECKPOINT_FILE = "embed_checkpoint.db"
+# Checkpointed vectors nobody resumed within this many seconds are dropped
+CHECKPOINT_TTL = float(os.getenv("RAG_EMBED_CHECKPOINT_TTL", 7 * 24 * 3600))
+
+EMBED_RETRIES = REGISTRY.counter("rag_embed_retries_total", "Retried ingestion embedding calls by reason.", ("provider", "reason"))
+
+
+def rate_limits(provider):
+    """(requests per minute, tokens per minute) for `provider`; 0 = unlimited."""
+    rpm, tpm = EMBED_RATE_LIMITS.get(provider, (0, 0))
+    return (int(EMBED_RPM) if EMBED_RPM else rpm), (int(EMBED_TPM) if EMBED_TPM else tpm)
+
+
+class RateLimiter:
+    """
+    Token buckets for requests and tokens per minute (0 disables a limit).
+    Buckets refill continuously and hold RATE_BURST_SECONDS of budget, so
+    calls are spread over the minute instead of all hitting its start.
+    A rate-limit answer from the provider pauses every caller.
+    """
+
+    def __init__(self, rpm, tpm, burst=RATE_BURST_SECONDS):
+        self.rates = (rpm / 60, tpm / 60)
+        self.capacity = tuple(max(1.0, rate * burst) for rate in self.rates)
+        self.levels = list(self.capacity)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def counts_tokens(self):
+        return self.rates[1] > 0
+
+    def acquire(self, tokens):
+        """Blocks until a request of `tokens` tokens fits both budgets, then spends it."""
+        needs = (1, tokens)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                for i, rate in enumerate(self.rates):
+                    self.levels[i] = min(self.capacity[i], self.levels[i] + (now - self.updated) * rate)
+                self.updated = now
+                delay = self.paused_until - now
+                if delay <= 0:
+                    # A call larger than a whole burst waits for a full bucket and goes into debt
+                    waits = [
+                        (min(need, capacity) - level) / rate
+                        for need, capacity, level, rate in zip(needs, self.capacity, self.levels, self.rates)
+                        if rate and level < min(need, capacity)
+                    ]
+                    if not waits:
+                        for i, rate in enumerate(self.rates):
+                            if rate:
+                                self.levels[i] -= needs[i]
+                        return
+                    delay = max(waits)
+            time.sleep(min(delay, 1.0))
+
+    def pause(self, seconds):
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+def _status_code(error):
+    for value in (getattr(error, "status_code", None), getattr(error, "code", None),
+                  getattr(getattr(error, "response", None), "status_code", None)):
+        if isinstance(value, int):
+            return value
+    return None
+
+
+def _retry_after(error):
+    """Seconds the provider asked us to wait (Retry-After headers), or None."""
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if value:
+            try:
+                return float(value)
+            except ValueError:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+def classify_error(error):
+    """"rate_limit", "transient" (worth retrying) or None (a real failure, e.g. a bad API key)."""
+    status = _status_code(error)
+    message = str(error).lower()
+    if status == 429 or "rate limit" in message or "resource_exhausted" in message:
+        return "rate_limit"
+    if status in (408, 409, 500, 502, 503, 504) or any(
+            name in type(error).__name__ for name in ("Timeout", "Connection", "Unavailable")):
+        return "transient"
+    return None
+
+
+class EmbedCheckpoint:
+    """
+    Vectors embedded by ingestions that have not been committed yet, keyed
+    by (model, chunk hash). Every finished batch is written here, so when an
+    upload fails and is sent again only the chunks that were never embedded
+    cost a provider call. process_files drops the rows once its segment is
+    committed.
+    """
+
+    def __init__(self, path, ttl=CHECKPOINT_TTL):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS checkpoint (
+                model TEXT,
+                chunk_hash TEXT,
+                vector BLOB,
+                created REAL,
+                PRIMARY KEY (model, chunk_hash)
+            )
+        ''')
+        self._conn.execute("DELETE FROM checkpoint WHERE created < ?", (time.time() - ttl,))
+        self._conn.commit()
+
+    def count(self, model):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM checkpoint WHERE model = ?", (model,)).fetchone()[0]
+
+    def get(self, model, chunk_hash):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT vector FROM checkpoint WHERE model = ? AND chunk_hash = ?", (model, chunk_hash)
+            ).fetchone()
+        return None if row is None else np.frombuffer(row[0], dtype=np.float32)
+
+    def put(self, model, chunk_hashes, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO checkpoint (model, chunk_hash, vector, created) VALUES (?, ?, ?, ?)",
+                ((model, chunk_hash, vector.tobytes(), now) for chunk_hash, vector in zip(chunk_hashes, vectors))
+            )
+
+    def delete(self, model, chunk_hashes):
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "DELETE FROM checkpoint WHERE model = ? AND chunk_hash = ?",
+                ((model, chunk_hash) for chunk_hash in chunk_hashes)
+            )
+
+    def close(self):
+        self._conn.close()
+
+
+class EmbedScheduler:
+    """
+    Ingestion-side embedding for one provider client: up to `concurrency`
+    batches in flight, within the provider's request and token budgets.
+    The batch size adapts AIMD-style: every successful call grows it by
+    EMBED_BATCH_STEP, every rate-limit answer halves it. Rate-limited and
+    transient failures are retried with exponential backoff (or the
+    provider's Retry-After) before the ingestion is given up.
+
+    One scheduler lives per provider client in the ClientPool, so what it
+    learned about the budget carries over to the next upload.
+    """
+
+    def __init__(self, embeddings, provider, concurrency=EMBED_CONCURRENCY):
+        self.embeddings = embeddings
+        self.provider = provider
+        self.limiter = RateLimiter(*rate_limits(provider))
+        self.batch_size = EMBED_BATCH_SIZE
+        self._size_lock = threading.Lock()
+        self.concurrency = concurrency
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix=f"embed-{provider}")
+
+    def _resize(self, throttled):
+        with self._size_lock:
+            if throttled:
+                self.batch_size = max(EMBED_MIN_BATCH, self.batch_size // 2)
+            else:
+                self.batch_size = min(EMBED_MAX_BATCH, self.batch_size + EMBED_BATCH_STEP)
+
+    def _call(self, batch, model, checkpoint, timings):
+        texts = [text for _, text, _, _ in batch]
+        tokens = sum(n for _, _, _, n in batch)
+        for attempt in range(EMBED_MAX_RETRIES + 1):
+            self.limiter.acquire(tokens)
+            try:
+                with timings.span("embed"):
+                    vectors = self.embeddings.embed_documents(texts)
+            except Exception as e:
+                reason = classify_error(e)
+                if reason is None or attempt == EMBED_MAX_RETRIES:
+                    raise
+                delay = _retry_after(e)
+                if delay is None:
+                    # Full jitter, so concurrent batches don't retry in lockstep
+                    delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+                if reason == "rate_limit":
+                    self._resize(throttled=True)
+                    self.limiter.pause(delay)
+                EMBED_RETRIES.inc(provider=self.provider, reason=reason)
+                print(f"⏳ Embedding batch of {len(batch)} hit {reason.replace('_', ' ')}, retrying in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+            self._resize(throttled=False)
+            if checkpoint is not None:
+                checkpoint.put(model, [key for key, _, _, _ in batch], vectors)
+            return [payload for _, _, payload, _ in batch], vectors
+
+    def embed(self, items, model, checkpoint=None, timings=NULL_TIMINGS):
+        """
+        Embeds `items` [(chunk hash, text, payload)] and yields
+        (payloads, vectors, resumed) per finished batch, in completion order.
+        Chunks found in `checkpoint` are not sent again; they come back in
+        batches with resumed=True. `items` is consumed lazily.
+        An error that survives the retries is raised here; batches already
+        in flight still finish (and are checkpointed) first.
+        """
+        items = iter(items)
+        # Lookups are skipped entirely while nothing is checkpointed for this model
+        if checkpoint is not None and not checkpoint.count(model):
+            lookup = None
+        else:
+            lookup = checkpoint
+        buffer = deque()
+        buffer_tokens = 0
+        resumed_payloads, resumed_vectors = [], []
+        exhausted = False
+        in_flight = set()
+        try:
+            while True:
+                while not exhausted and len(buffer) < self.batch_size and buffer_tokens < EMBED_MAX_BATCH_TOKENS:
+                    item = next(items, None)
+                    if item is None:
+                        exhausted = True
+                        break
+                    key, text, payload = item
+                    vector = lookup.get(model, key) if lookup is not None else None
+                    if vector is not None:
+                        resumed_payloads.append(payload)
+                        resumed_vectors.append(vector)
+                        continue
+                    tokens = count_tokens(text) if self.limiter.counts_tokens else 0
+                    buffer.append((key, text, payload, tokens))
+                    buffer_tokens += tokens
+
+                if resumed_payloads and (exhausted or len(resumed_payloads) >= self.batch_size):
+                    yield resumed_payloads, resumed_vectors, True
+                    resumed_payloads, resumed_vectors = [], []
+
+                # Full batches go out while slots are free; a partial one only at the end
+                while buffer and len(in_flight) < self.concurrency and (
+                        exhausted or len(buffer) >= self.batch_size or buffer_tokens >= EMBED_MAX_BATCH_TOKENS):
+                    batch, tokens = [], 0
+                    while buffer and len(batch) < self.batch_size and (
+                            not batch or tokens + buffer[0][3] <= EMBED_MAX_BATCH_TOKENS):
+                        item = buffer.popleft()
+                        batch.append(item)
+                        tokens += item[3]
+                    buffer_tokens -= tokens
+                    in_flight.add(self._executor.submit(self._call, batch, model, checkpoint, timings))
+
+                if not in_flight:
+                    if exhausted and not buffer:
+                        break
+                    continue
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    payloads, vectors = future.result()
+                    yield payloads, vectors, False
+        finally:
+            for future in in_flight:
+                future.cancel()
+            wait(in_flight)
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,133 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+# File used for the persistent (second) cache tier
+EMBED_CACHE_PATH = "embedding_cache.db"
+
+
+def normalize_text(text):
+    """Collapses whitespace so trivially different spellings share a cache entry."""
+    return " ".join(str(text).split())
+
+
+def make_cache_key(provider, model, text):
+    raw = f"{provider}\x00{model}\x00{normalize_text(text)}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Two-tier cache for query embeddings.
+    Tier 1 is an in-memory LRU, tier 2 is a SQLite file that survives restarts.
+    Both tiers are size-bounded and evict the least recently used entries.
+    """
+
+    def __init__(self, path=EMBED_CACHE_PATH, max_memory_items=2048, max_disk_items=100000):
+        self.path = path
+        self.max_memory_items = max_memory_items
+        self.max_disk_items = max_disk_items
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        self._disk_count = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _get_conn(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    key TEXT PRIMARY KEY,
+                    vector BLOB,
+                    last_access REAL
+                )
+            ''')
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_access ON embeddings (last_access)")
+            self._conn.commit()
+            self._disk_count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        return self._conn
+
+    def _remember(self, key, vector):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def get(self, key):
+        """Returns the cached vector for `key` or None."""
+        with self._lock:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return vector
+
+            try:
+                conn = self._get_conn()
+                row = conn.execute("SELECT vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    conn.execute("UPDATE embeddings SET last_access = ? WHERE key = ?", (time.time(), key))
+                    conn.commit()
+            except sqlite3.Error as e:
+                print(f"⚠️ Embedding cache read error: {e}")
+                row = None
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            vector = np.frombuffer(row[0], dtype=np.float32)
+            self._remember(key, vector)
+            self.disk_hits += 1
+            return vector
+
+    def put(self, key, vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        with self._lock:
+            self._remember(key, vector)
+            try:
+                conn = self._get_conn()
+                now = time.time()
+                inserted = conn.execute(
+                    "INSERT INTO embeddings (key, vector, last_access) VALUES (?, ?, ?) ON CONFLICT (key) DO NOTHING",
+                    (key, vector.tobytes(), now)
+                ).rowcount
+                if inserted:
+                    self._disk_count += 1
+                else:
+                    # Existing key: refreshed in place, so the row count is unchanged
+                    conn.execute(
+                        "UPDATE embeddings SET vector = ?, last_access = ? WHERE key = ?",
+                        (vector.tobytes(), now, key)
+                    )
+                if self._disk_count > self.max_disk_items:
+                    # Trim back to 90% of the cap so we don't evict on every insert
+                    keep = int(self.max_disk_items * 0.9)
+                    conn.execute('''
+                        DELETE FROM embeddings WHERE key IN (
+                            SELECT key FROM embeddings ORDER BY last_access ASC LIMIT ?
+                        )
+                    ''', (self._disk_count - keep,))
+                    self._disk_count = conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+                conn.commit()
+            except sqlite3.Error as e:
+                print(f"⚠️ Embedding cache write error: {e}")
+
+    def stats(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        hits = self.memory_hits + self.disk_hits
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": float(round(hits / lookups, 4)) if lookups else 0.0,
+            "memory_items": len(self._memory),
+            "disk_items": self._disk_count,
+        }
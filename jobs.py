@@ -0,0 +1,110 @@
+import os
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Ingestion jobs that run at the same time. Each one already parses and
+# embeds in parallel internally, so 1 keeps CPU free for query serving.
+INGEST_WORKERS = int(os.getenv("RAG_INGEST_WORKERS", 1))
+# Jobs allowed to wait or run before new uploads are refused (HTTP 429)
+INGEST_MAX_PENDING = int(os.getenv("RAG_INGEST_MAX_PENDING", 8))
+# Finished jobs kept for /jobs/{id} before the oldest are forgotten
+JOB_HISTORY = int(os.getenv("RAG_JOB_HISTORY", 1000))
+
+
+class QueueFull(Exception):
+    """Raised by submit() when INGEST_MAX_PENDING jobs are already waiting or running."""
+
+
+class IngestJobQueue:
+    """
+    Background ingestion: submit() returns a job id at once and the work runs
+    on a small dedicated thread pool, separate from the threads serving
+    queries. Job state lives in plain dicts that status() copies out.
+    """
+
+    def __init__(self, workers=INGEST_WORKERS, max_pending=INGEST_MAX_PENDING, history=JOB_HISTORY):
+        self.max_pending = max_pending
+        self.history = history
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ingest")
+        # job id -> job dict, oldest first
+        self._jobs = OrderedDict()
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Claims a pending slot and returns a new job id, or raises QueueFull.
+        Called before the upload is saved so a full queue costs no disk I/O.
+        """
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise QueueFull(f"{self._pending} ingestion jobs already pending")
+            self._pending += 1
+            job_id = uuid.uuid4().hex
+            self._jobs[job_id] = {
+                "id": job_id, "status": "reserved", "created": time.time(),
+                "started": None, "finished": None, "progress": {}, "result": None, "error": None
+            }
+            return job_id
+
+    def release(self, job_id):
+        """Gives a reserved slot back when the upload never made it to submit()."""
+        with self._lock:
+            if self._jobs.pop(job_id, None) is not None:
+                self._pending -= 1
+
+    def submit(self, job_id, fn, progress, **info):
+        """
+        Runs fn(progress) in the background for a reserved job. `progress` is
+        the dict fn updates as it goes; `info` is extra fields shown in status().
+        """
+        with self._lock:
+            job = self._jobs[job_id]
+            job.update(info, status="queued", progress=progress)
+        self._executor.submit(self._run, job, fn)
+        return job_id
+
+    def _run(self, job, fn):
+        job["status"] = "running"
+        job["started"] = time.time()
+        try:
+            job["result"] = fn(job["progress"])
+            job["status"] = "done"
+        except Exception as e:
+            print(f"❌ Ingestion job {job['id']} failed: {e}")
+            job["error"] = str(e)
+            job["status"] = "failed"
+        finally:
+            job["finished"] = time.time()
+            with self._lock:
+                self._pending -= 1
+                self._forget_old()
+
+    def _forget_old(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job["finished"] is not None]
+        for job_id in finished[:max(0, len(finished) - self.history)]:
+            del self._jobs[job_id]
+
+    def status(self, job_id):
+        """Snapshot of a job (None if unknown), safe to serialise while it runs."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            snapshot = dict(job)
+        progress = dict(snapshot["progress"])
+        if "errors" in progress:
+            progress["errors"] = list(progress["errors"])
+        snapshot["progress"] = progress
+        return snapshot
+
+    def stats(self):
+        with self._lock:
+            statuses = [job["status"] for job in self._jobs.values()]
+        return {status: statuses.count(status) for status in ("queued", "running", "done", "failed")}
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
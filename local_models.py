@@ -0,0 +1,106 @@
+import os
+import re
+import time
+import hashlib
+from typing import Any, Iterator, List, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+# Offline stand-ins for provider="local" (benchmarks, demos without API keys)
+LOCAL_EMBED_DIM = int(os.getenv("RAG_LOCAL_EMBED_DIM", 384))
+# Simulated provider latency in seconds: per embedding call, before the first token, per token
+LOCAL_EMBED_LATENCY = float(os.getenv("RAG_LOCAL_EMBED_LATENCY", 0))
+LOCAL_LLM_LATENCY = float(os.getenv("RAG_LOCAL_LLM_LATENCY", 0))
+LOCAL_TOKEN_LATENCY = float(os.getenv("RAG_LOCAL_TOKEN_LATENCY", 0))
+
+_WORD = re.compile(r"\w+")
+
+
+class HashingEmbeddings(Embeddings):
+    """
+    Deterministic bag-of-words embedder: every word is hashed into one of
+    `dim` signed buckets and the result is L2-normalised. Texts sharing words
+    land close together, so retrieval behaves sensibly without a model.
+    """
+
+    def __init__(self, dim=LOCAL_EMBED_DIM, latency=LOCAL_EMBED_LATENCY):
+        self.dim = dim
+        self.latency = latency
+        self._buckets = {}
+
+    def _bucket(self, word):
+        bucket = self._buckets.get(word)
+        if bucket is None:
+            h = int.from_bytes(hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest(), "little")
+            bucket = (h % self.dim, 1.0 if (h >> 32) & 1 else -1.0)
+            self._buckets[word] = bucket
+        return bucket
+
+    def _embed(self, texts):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in _WORD.findall(text.lower()):
+                column, sign = self._bucket(word)
+                vectors[row, column] += sign
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        np.divide(vectors, norms, out=vectors, where=norms > 0)
+        return vectors
+
+    def embed_documents(self, texts):
+        if self.latency:
+            time.sleep(self.latency)
+        return self._embed(texts).tolist()
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+class EchoChatModel(BaseChatModel):
+    """
+    Template LLM: answers by quoting the question and the first context
+    source of the prompt, and returns two fixed rephrasings for the
+    query-variation prompt. Latency before the first token and per token
+    is configurable.
+    """
+
+    latency: float = LOCAL_LLM_LATENCY
+    token_latency: float = LOCAL_TOKEN_LATENCY
+
+    @property
+    def _llm_type(self):
+        return "local-echo"
+
+    def _answer(self, messages):
+        prompt = str(messages[-1].content)
+        if "Generate 2 synonyms" in prompt:
+            question = re.search(r'for: "(.*)"', prompt)
+            question = question.group(1) if question else ""
+            return f"What about {question}?\nDetails on {question}"
+        question = re.search(r"Question:\s*(.*)", prompt)
+        source = re.search(r"\[Source: (.*?)\]", prompt)
+        return (
+            f"Based on the documents, here is what they say about "
+            f"\"{question.group(1).strip() if question else ''}\". "
+            f"[{source.group(1) if source else 'Unknown'}]"
+        )
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        text = self._answer(messages)
+        if self.latency:
+            time.sleep(self.latency)
+        if self.token_latency:
+            time.sleep(self.token_latency * len(text.split()))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        text = self._answer(messages)
+        if self.latency:
+            time.sleep(self.latency)
+        for token in re.findall(r"\S+\s*", text):
+            if self.token_latency:
+                time.sleep(self.token_latency)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
@@ -1,18 +1,29 @@
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from pydantic import BaseModel
 from typing import List, Optional
 import shutil
+import json
 import os
 
 # Imports form local files
-from rag_engine import RAGManager
-from database import init_db, add_message, get_chat_history
+from rag_engine import RAGManager, new_progress
+from jobs import IngestJobQueue, QueueFull
+from database import init_db, add_messages, get_chat_context
+from metrics import REGISTRY, start_timings
 
 app = FastAPI(title="RAG Agent Backend")
 
 # Initialize Systems
 rag_manager = RAGManager()
 init_db()
+REGISTRY.collector(rag_manager.collect_metrics)
+# Uploads are ingested in the background by a small dedicated worker pool
+ingest_jobs = IngestJobQueue()
+REGISTRY.collector(lambda: [(
+    "rag_ingest_jobs", "gauge", "Ingestion jobs by status.",
+    [({"status": status}, count) for status, count in ingest_jobs.stats().items()]
+)])
 
 # Create data directory to store uploaded files temporarily
 os.makedirs("data", exist_ok=True)
@@ -24,9 +35,38 @@ class QueryRequest(BaseModel):
     username: str   
     provider: str   
     api_key: str
+    include_timings: bool = False  # Adds per-stage durations (ms) to the response
+
+def reserve_job():
+    """Backpressure: refuse before touching the disk if too many ingestion jobs are pending."""
+    try:
+        return ingest_jobs.reserve()
+    except QueueFull as e:
+        raise HTTPException(status_code=429, detail=f"Ingestion queue is full, retry later ({e}).")
+
+def job_dir(job_id):
+    # Each job gets its own folder so concurrent uploads of the same file name don't clash
+    return os.path.join("data", job_id)
+
+def save_job_files(job_id, uploads):
+    """Saves (file name, UploadFile) pairs for a reserved job and returns their paths."""
+    try:
+        os.makedirs(job_dir(job_id), exist_ok=True)
+        saved_paths = []
+        for file_name, file in uploads:
+            file_location = os.path.join(job_dir(job_id), os.path.basename(file_name))
+            with open(file_location, "wb") as buffer:
+                shutil.copyfileobj(file.file, buffer)
+            saved_paths.append(file_location)
+        return saved_paths
+    except Exception as e:
+        shutil.rmtree(job_dir(job_id), ignore_errors=True)
+        ingest_jobs.release(job_id)
+        print(f"Error in upload: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/upload/")
-async def upload_files(
+def upload_files(
     files: List[UploadFile] = File(...),
     username: str = Form(...),  
     privacy: str = Form(...),   
@@ -35,47 +75,105 @@ async def upload_files(
 ):
     """
     Endpoint to upload PDF/TXT/DOCX files, tag them with User/Privacy, 
-    and ingest them into the Persistent Vector DB.
+    and queue them for ingestion into the Persistent Vector DB.
+    Returns a job ID at once; poll /jobs/{job_id} for progress.
     """
-    saved_paths = []
-    try:
-        # Save files to disk temporarily
-        for file in files:
-            file_location = f"data/{file.filename}"
-            with open(file_location, "wb") as buffer:
-                shutil.copyfileobj(file.file, buffer)
-            saved_paths.append(file_location)
-        
-        # Process files with Metadata (Username & Privacy)
-        num_chunks = rag_manager.process_files(
-            file_paths=saved_paths,
-            username=username,
-            privacy=privacy,
-            provider=provider,
-            api_key=api_key
-        )
-        
-        # Clean up temp files after processing (Optional, uncomment if needed)
-        # for path in saved_paths:
-        #     os.remove(path)
-        
+    job_id = reserve_job()
+    saved_paths = save_job_files(job_id, [(file.filename, file) for file in files])
+
+    def ingest(progress):
+        try:
+            # Process files with Metadata (Username & Privacy)
+            num_chunks = rag_manager.process_files(
+                file_paths=saved_paths,
+                username=username,
+                privacy=privacy,
+                provider=provider,
+                api_key=api_key,
+                progress=progress
+            )
+        finally:
+            # The uploads are in the index (or the job failed): their copies aren't needed any more
+            shutil.rmtree(job_dir(job_id), ignore_errors=True)
         return {
-            "status": "success", 
-            "message": f"Successfully processed {len(files)} files into {num_chunks} chunks for user '{username}' ({privacy} mode)."
+            "chunks": num_chunks,
+            "message": f"Successfully processed {len(saved_paths)} files into {num_chunks} chunks for user '{username}' ({privacy} mode)."
         }
-    
-    except Exception as e:
-        print(f"Error in upload: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+
+    ingest_jobs.submit(job_id, ingest, new_progress(), username=username, privacy=privacy, files=[f.filename for f in files])
+    return {
+        "status": "queued",
+        "job_id": job_id,
+        "message": f"Queued {len(saved_paths)} files for ingestion. Poll /jobs/{job_id} for progress."
+    }
+
+@app.get("/documents/")
+def list_documents(username: str):
+    """Files uploaded by `username`, with their privacy and chunk count."""
+    return {"documents": rag_manager.list_documents(username)}
+
+@app.delete("/documents/{file_name}")
+def delete_document(file_name: str, username: str):
+    """
+    Removes one of the user's files from the index. Its chunks stop appearing
+    in answers immediately; the space is reclaimed by background compaction.
+    """
+    deleted = rag_manager.delete_documents([file_name], username)
+    if not deleted:
+        raise HTTPException(status_code=404, detail=f"No document '{file_name}' for user '{username}'.")
+    return {"status": "deleted", "source": file_name, "chunks": deleted[file_name]}
+
+@app.put("/documents/{file_name}")
+def replace_document(
+    file_name: str,
+    file: UploadFile = File(...),
+    username: str = Form(...),
+    privacy: str = Form(...),
+    provider: str = Form(...),
+    api_key: str = Form(...),
+    new_name: Optional[str] = Form(None)
+):
+    """
+    Replaces `file_name` with the uploaded file (stored as `new_name` if given).
+    Only chunks that changed are embedded. Runs as an ingestion job like /upload/.
+    """
+    job_id = reserve_job()
+    saved_paths = save_job_files(job_id, [(new_name or file_name, file)])
+
+    def ingest(progress):
+        try:
+            num_chunks = rag_manager.replace_document(
+                saved_paths[0], username, privacy, provider, api_key, replaces=file_name, progress=progress
+            )
+        finally:
+            shutil.rmtree(job_dir(job_id), ignore_errors=True)
+        return {"chunks": num_chunks, "message": f"Replaced '{file_name}' with {num_chunks} chunks."}
+
+    ingest_jobs.submit(job_id, ingest, new_progress(), username=username, privacy=privacy, files=[file_name])
+    return {"status": "queued", "job_id": job_id, "message": f"Queued replacement of '{file_name}'. Poll /jobs/{job_id} for progress."}
+
+@app.get("/jobs/{job_id}")
+def job_status(job_id: str):
+    """Status of an ingestion job: queued/running/done/failed, files parsed, chunks embedded, errors."""
+    job = ingest_jobs.status(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job ID.")
+    return job
 
 @app.post("/chat/")
-async def chat_endpoint(request: QueryRequest):
+def chat_endpoint(request: QueryRequest):
     """
     Endpoint to handle queries with history, RAG context, and Privacy Filtering.
+    A plain `def`, so FastAPI runs it in its threadpool and a slow LLM call
+    never blocks the event loop (or other requests).
     """
     try:
+        timings = start_timings("chat", request.include_timings)
+
         # 1. Get Chat History from SQLite
-        history = get_chat_history(request.session_id)
+        # Older turns come back as a stored summary instead of verbatim messages
+        with timings.span("history"):
+            history, summary = get_chat_context(request.session_id)
         
         # 2. Get Answer from RAG Engine with Privacy Check
         result = rag_manager.get_answer(
@@ -83,12 +181,19 @@ async def chat_endpoint(request: QueryRequest):
             history=history,
             username=request.username, # Pass username to filter private docs
             provider=request.provider,
-            api_key=request.api_key
+            api_key=request.api_key,
+            include_timings=request.include_timings,
+            history_summary=summary
         )
         
         # 3. Save Conversation to Memory (SQLite)
-        add_message(request.session_id, "user", request.query)
-        add_message(request.session_id, "assistant", result["answer"])
+        with timings.span("save"):
+            add_messages(request.session_id, [("user", request.query), ("assistant", result["answer"])])
+
+        chat_timings = timings.finish()
+        if request.include_timings:
+            # total_ms now covers the whole request, history fetch and save included
+            result["timings"].update(chat_timings)
         
         return result
         
@@ -96,4 +201,43 @@ async def chat_endpoint(request: QueryRequest):
         print(f"Error in chat: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/chat/stream")
+def chat_stream_endpoint(request: QueryRequest):
+    """
+    Same as /chat/ but streams the answer as Server-Sent Events:
+    `token` events carry pieces of the answer as they are generated, a final
+    `final` event carries the full result (answer, sources, confidence).
+    """
+    history, summary = get_chat_context(request.session_id)
+
+    def event_stream():
+        try:
+            for frame in rag_manager.stream_answer(
+                query=request.query,
+                history=history,
+                username=request.username,
+                provider=request.provider,
+                api_key=request.api_key,
+                include_timings=request.include_timings,
+                history_summary=summary
+            ):
+                if frame["type"] == "final":
+                    add_messages(request.session_id, [("user", request.query), ("assistant", frame["answer"])])
+                yield f"event: {frame['type']}\ndata: {json.dumps(frame)}\n\n"
+        except Exception as e:
+            print(f"Error in chat stream: {e}")
+            yield f"event: error\ndata: {json.dumps({'type': 'error', 'detail': str(e)})}\n\n"
+
+    # A sync generator is iterated in the threadpool, so the event loop is never blocked
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/metrics")
+def metrics_endpoint():
+    """Prometheus metrics: stage latency histograms, cache hit rates, index size, ingestion counters."""
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
 # Run with: uvicorn main:app --reload
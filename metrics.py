@@ -0,0 +1,198 @@
+import os
+import time
+import threading
+from contextlib import contextmanager, nullcontext
+
+# Set RAG_METRICS=0 to turn timing spans and metric updates into no-ops
+METRICS_ENABLED = os.getenv("RAG_METRICS", "1") == "1"
+
+# Histogram buckets in seconds, from a cache hit up to a slow LLM call
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    pairs = []
+    for key, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{key}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(zip(self.labelnames, key))} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # label values -> [per-bucket counts, sum, count]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (bucket_counts, total, count) in sorted(self._values.items()):
+                labels = list(zip(self.labelnames, key))
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    cumulative += bucket_count
+                    lines.append(f"{self.name}_bucket{_format_labels(labels + [('le', bound)])} {cumulative}")
+                lines.append(f"{self.name}_bucket{_format_labels(labels + [('le', '+Inf')])} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(labels)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return lines
+
+
+class Registry:
+    """
+    Minimal Prometheus registry: counters and histograms updated in place,
+    plus collectors called at scrape time for values that already live
+    elsewhere (cache statistics, index size).
+    A collector returns [(name, type, help, [(labels dict, value), ...]), ...].
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, help_text, labelnames=()):
+        metric = Counter(name, help_text, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, help_text, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def collector(self, collect):
+        self._collectors.append(collect)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collect in self._collectors:
+            try:
+                families = collect()
+            except Exception as e:
+                print(f"⚠️ Metrics collector failed: {e}")
+                continue
+            for name, kind, help_text, samples in families:
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_format_labels(sorted(labels.items()))} {value}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram("rag_stage_seconds", "Time spent per pipeline stage.", ("operation", "stage"))
+REQUEST_SECONDS = REGISTRY.histogram("rag_request_seconds", "End-to-end time per operation.", ("operation",))
+INGESTED_FILES = REGISTRY.counter("rag_ingested_files_total", "Uploaded files by outcome.", ("status",))
+INGESTED_CHUNKS = REGISTRY.counter("rag_ingested_chunks_total", "Chunks of ingested files by how their vector was obtained.", ("kind",))
+
+
+class Timings:
+    """
+    Stage timer for one call: `with timings.span("search"): ...`.
+    Every span is observed in STAGE_SECONDS; finish() observes the total and
+    returns {"<stage>_ms": ...} for callers that asked for timings.
+    Spans of the same stage add up (e.g. one "embed" span per batch).
+    """
+
+    def __init__(self, operation):
+        self.operation = operation
+        self.stages = {}
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+        STAGE_SECONDS.observe(seconds, operation=self.operation, stage=stage)
+
+    @contextmanager
+    def span(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def mark(self, stage):
+        """Records the time from the start of the call until now (e.g. first token)."""
+        self.add(stage, time.perf_counter() - self._start)
+
+    def finish(self):
+        total = time.perf_counter() - self._start
+        REQUEST_SECONDS.observe(total, operation=self.operation)
+        with self._lock:
+            timings = {f"{stage}_ms": round(seconds * 1000, 3) for stage, seconds in self.stages.items()}
+        timings["total_ms"] = round(total * 1000, 3)
+        return timings
+
+
+class _NullTimings:
+    """Stand-in used when metrics are off and no timings were requested."""
+
+    def add(self, stage, seconds):
+        pass
+
+    def span(self, stage):
+        return nullcontext()
+
+    def mark(self, stage):
+        pass
+
+    def finish(self):
+        return {}
+
+
+NULL_TIMINGS = _NullTimings()
+
+
+def start_timings(operation, keep=False):
+    """Returns a Timings for `operation`, or a no-op one if nobody will read it."""
+    return Timings(operation) if METRICS_ENABLED or keep else NULL_TIMINGS
@@ -0,0 +1,279 @@
+import os
+import time
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+from pypdf import PdfReader
+from langchain_community.document_loaders import PyPDFLoader, TextLoader, Docx2txtLoader
+from langchain_classic.schema import Document
+
+# Worker processes used to parse uploads (1 = parse in the calling process)
+PARSE_WORKERS = int(os.getenv("RAG_PARSE_WORKERS", min(4, os.cpu_count() or 1)))
+# Seconds a single file may spend parsing before it is reported as failed
+PARSE_TIMEOUT = float(os.getenv("RAG_PARSE_TIMEOUT", 300))
+# PDFs longer than this are split into page ranges parsed in parallel
+PDF_PAGES_PER_TASK = int(os.getenv("RAG_PDF_PAGES_PER_TASK", 50))
+# How worker processes start. Forking the (threaded) server can copy a lock
+# another thread holds into the child, so they come from a fork server or spawn
+PARSE_START_METHOD = os.getenv(
+    "RAG_PARSE_START_METHOD",
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+
+# workers -> the shared process pool of that size, started on first use
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def load_file(file_path):
+    """Loads a whole file into LangChain Documents (one per PDF page)."""
+    if file_path.endswith(".pdf"):
+        loader = PyPDFLoader(file_path)
+    elif file_path.endswith(".docx"):
+        loader = Docx2txtLoader(file_path)
+    else:
+        loader = TextLoader(file_path)
+    return loader.load()
+
+
+def load_pdf_pages(file_path, start, end):
+    """Loads pages [start, end) of a PDF, with the same metadata PyPDFLoader sets."""
+    reader = PdfReader(file_path)
+    total_pages = len(reader.pages)
+    page_labels = reader.page_labels
+    docs = []
+    for page_number in range(start, min(end, total_pages)):
+        page = reader.pages[page_number]
+        docs.append(Document(
+            page_content=page.extract_text(),
+            metadata={
+                "source": file_path,
+                "total_pages": total_pages,
+                "page": page_number,
+                "page_label": page_labels[page_number],
+            }
+        ))
+    return docs
+
+
+def get_pool(workers):
+    """The long-lived parse pool with `workers` processes, shared by every upload."""
+    with _pools_lock:
+        pool = _pools.get(workers)
+        if pool is None:
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(PARSE_START_METHOD))
+            _pools[workers] = pool
+        return pool
+
+
+def _retire_pool(pool):
+    """
+    Kills the workers of `pool` (one is stuck on a file, or one crashed) and
+    drops it, so the next get_pool() starts a fresh one. Parts other uploads
+    had in it fail with BrokenProcessPool and are resubmitted by them.
+    """
+    with _pools_lock:
+        for workers, current in list(_pools.items()):
+            if current is pool:
+                del _pools[workers]
+    for process in list((getattr(pool, "_processes", None) or {}).values()):
+        process.terminate()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def shutdown_pools():
+    """Stops every parse pool (their workers exit once idle)."""
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def _call_with_timeout(timeout, func, *args):
+    """
+    func(*args) in a helper thread, raising TimeoutError after `timeout` seconds.
+    A thread can't be stopped: a timed-out file keeps parsing in the
+    background, but the upload moves on without it.
+    """
+    outcome = {}
+
+    def run():
+        try:
+            outcome["result"] = func(*args)
+        except BaseException as e:
+            outcome["error"] = e
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive():
+        raise TimeoutError(f"parsing took longer than {timeout:.0f}s")
+    if "error" in outcome:
+        raise outcome["error"]
+    return outcome["result"]
+
+
+def _load_and_split(split, func, args):
+    return split(func(*args))
+
+
+def _plan_tasks(file_path):
+    """Returns the (function, args) units of work for one file."""
+    if file_path.endswith(".pdf"):
+        try:
+            total_pages = len(PdfReader(file_path).pages)
+        except Exception:
+            # Let the real loader raise a proper error inside the worker
+            total_pages = 0
+        if total_pages > PDF_PAGES_PER_TASK:
+            return [
+                (load_pdf_pages, (file_path, start, start + PDF_PAGES_PER_TASK))
+                for start in range(0, total_pages, PDF_PAGES_PER_TASK)
+            ]
+    return [(load_file, (file_path,))]
+
+
+def parse_files(file_paths, workers=None, timeout=None, split=None):
+    """
+    Parses files in the shared process pool and yields (file_path, docs, error) for
+    each file as soon as all of its parts are done, in completion order.
+    Exactly one of docs / error is None.
+
+    `split` (a picklable function of a file's docs) also runs in the pool,
+    right after loading; for files parsed in parts it runs once all parts
+    are in, as one more task. docs are then its result.
+
+    `file_paths` is consumed lazily and at most 2 * workers parts are in
+    flight, so finished-but-unconsumed results never pile up in memory.
+    A file still parsing after `timeout` seconds is reported as failed, in
+    both the pool and the in-process (workers <= 1) path.
+    """
+    workers = PARSE_WORKERS if workers is None else workers
+    timeout = PARSE_TIMEOUT if timeout is None else timeout
+
+    if workers <= 1:
+        for file_path in dict.fromkeys(file_paths):
+            try:
+                if split:
+                    docs = _call_with_timeout(timeout, _load_and_split, split, load_file, (file_path,))
+                else:
+                    docs = _call_with_timeout(timeout, load_file, file_path)
+                yield file_path, docs, None
+            except Exception as e:
+                yield file_path, None, e
+        return
+
+    def iter_tasks():
+        seen = set()
+        for file_path in file_paths:
+            if file_path in seen:
+                continue
+            seen.add(file_path)
+            tasks = _plan_tasks(file_path)
+            if split and len(tasks) == 1:
+                func, args = tasks[0]
+                tasks = [(_load_and_split, (split, func, args))]
+            for part, (func, args) in enumerate(tasks):
+                yield file_path, part, len(tasks), func, args
+
+    # future -> (file_path, part number, func, args, pool); parts[file_path] = list of per-part results
+    owners = {}
+    parts = {}
+    started = {}
+    failed = set()
+    retried = set()
+    pending = set()
+
+    def submit(file_path, part, func, args):
+        pool = get_pool(workers)
+        try:
+            future = pool.submit(func, *args)
+        except (BrokenProcessPool, RuntimeError):
+            # Retired by another upload between get_pool() and submit()
+            _retire_pool(pool)
+            pool = get_pool(workers)
+            future = pool.submit(func, *args)
+        owners[future] = (file_path, part, func, args, pool)
+        pending.add(future)
+
+    try:
+        tasks = iter_tasks()
+        exhausted = False
+
+        while True:
+            while not exhausted and len(pending) < workers * 2:
+                task = next(tasks, None)
+                if task is None:
+                    exhausted = True
+                    break
+                file_path, part, total_parts, func, args = task
+                if file_path in failed:
+                    continue
+                if part == 0:
+                    parts[file_path] = [None] * total_parts
+                submit(file_path, part, func, args)
+
+            if not pending:
+                break
+
+            done, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+            now = time.monotonic()
+
+            for future in done:
+                file_path, part, func, args, pool = owners.pop(future)
+                if file_path in failed:
+                    continue
+                error = None if future.cancelled() else future.exception()
+                if future.cancelled() or isinstance(error, BrokenProcessPool):
+                    # The pool died under this part (a timeout or crash elsewhere): one more try in a fresh one
+                    _retire_pool(pool)
+                    if (file_path, part) not in retried:
+                        retried.add((file_path, part))
+                        started.pop(file_path, None)
+                        submit(file_path, part, func, args)
+                        continue
+                    error = error or BrokenProcessPool("parse worker stopped")
+                if error is not None:
+                    failed.add(file_path)
+                    parts.pop(file_path, None)
+                    yield file_path, None, error
+                    continue
+                parts[file_path][part] = future.result()
+                if all(p is not None for p in parts[file_path]):
+                    loaded = parts.pop(file_path)
+                    docs = [doc for part_docs in loaded for doc in part_docs]
+                    if split and len(loaded) > 1:
+                        # All parts are in: split the whole file as one more (single-part) task
+                        parts[file_path] = [None]
+                        submit(file_path, 0, split, (docs,))
+                        continue
+                    yield file_path, docs, None
+
+            # The timeout clock of a file starts when its first part starts running
+            for future in list(pending):
+                if future not in pending:
+                    continue
+                file_path, _, _, _, pool = owners[future]
+                if file_path in failed:
+                    future.cancel()
+                    pending.discard(future)
+                    continue
+                if future.running():
+                    started.setdefault(file_path, now)
+                if file_path in started and now - started[file_path] > timeout:
+                    failed.add(file_path)
+                    parts.pop(file_path, None)
+                    for other in list(pending):
+                        if owners[other][0] == file_path:
+                            pending.discard(other)
+                            owners.pop(other)
+                    # A worker stuck on the file can only be stopped by killing it
+                    _retire_pool(pool)
+                    yield file_path, None, TimeoutError(f"parsing took longer than {timeout:.0f}s")
+    finally:
+        # Parts nobody will collect any more (the caller stopped early)
+        for future in pending:
+            future.cancel()
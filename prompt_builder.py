@@ -0,0 +1,250 @@
+import os
+import re
+import threading
+
+import numpy as np
+
+from chunk_store import lexical_terms
+
+# Total tokens the prompt may use (instructions, history, context and question)
+PROMPT_TOKEN_BUDGET = int(os.getenv("RAG_PROMPT_TOKEN_BUDGET", 2500))
+# Tokens of verbatim recent history; older turns are folded into the summary
+HISTORY_TOKEN_BUDGET = int(os.getenv("RAG_HISTORY_TOKEN_BUDGET", 600))
+# Recent messages kept verbatim at most, whatever their size
+HISTORY_MAX_MESSAGES = int(os.getenv("RAG_HISTORY_MAX_MESSAGES", 10))
+# Size cap of the rolling summary of older turns; its oldest lines go first
+SUMMARY_TOKEN_BUDGET = int(os.getenv("RAG_SUMMARY_TOKEN_BUDGET", 300))
+# Longest line one folded message contributes to the summary
+SUMMARY_LINE_TOKENS = 40
+# Context tokens per retrieved chunk at most; longer chunks keep only their relevant sentences.
+# 0 = the chunk size (RAG_CHUNK_SIZE_TOKENS), so only chunks of older, larger splits are trimmed
+CHUNK_TOKEN_LIMIT = int(os.getenv("RAG_CHUNK_TOKEN_LIMIT", 0))
+# tiktoken encoding (o200k_base = gpt-4o family; a close estimate for the other providers)
+TOKEN_ENCODING = os.getenv("RAG_TOKEN_ENCODING", "o200k_base")
+
+_SENTENCE = re.compile(r"[^.!?\n]+(?:[.!?]+|\n|$)")
+# Fallback tokenizer: words and punctuation, within ~15% of BPE counts on English text
+_ROUGH_TOKEN = re.compile(r"\w+|[^\w\s]")
+
+_encoding = None
+_encoding_failed = False
+_encoding_lock = threading.Lock()
+# Byte length of every token of the encoding, indexed by token id
+_token_bytes = None
+
+
+def _get_encoding():
+    """The tiktoken encoding, or None when it can't be loaded (e.g. offline, first run)."""
+    global _encoding, _encoding_failed
+    if _encoding is None and not _encoding_failed:
+        with _encoding_lock:
+            if _encoding is None and not _encoding_failed:
+                try:
+                    import tiktoken
+                    _encoding = tiktoken.get_encoding(TOKEN_ENCODING)
+                except Exception as e:
+                    print(f"⚠️ tiktoken unavailable ({e}), estimating token counts.")
+                    _encoding_failed = True
+    return _encoding
+
+
+def count_tokens(text):
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return len(_ROUGH_TOKEN.findall(text))
+
+
+def truncate_tokens(text, max_tokens):
+    """The longest prefix of `text` with at most `max_tokens` tokens."""
+    if max_tokens <= 0:
+        return ""
+    encoding = _get_encoding()
+    if encoding is not None:
+        tokens = encoding.encode(text, disallowed_special=())
+        return text if len(tokens) <= max_tokens else encoding.decode(tokens[:max_tokens])
+    matches = list(_ROUGH_TOKEN.finditer(text))
+    return text if len(matches) <= max_tokens else text[:matches[max_tokens - 1].end()]
+
+
+def _token_byte_lengths(encoding):
+    global _token_bytes
+    if _token_bytes is None:
+        lengths = np.zeros(encoding.n_vocab, dtype=np.int64)
+        for token in range(encoding.n_vocab):
+            try:
+                lengths[token] = len(encoding.decode_single_token_bytes(token))
+            except KeyError:
+                # Unused ids between the regular and the special tokens
+                pass
+        _token_bytes = lengths
+    return _token_bytes
+
+
+def _char_kind(char):
+    """0 = whitespace, 1 = word character, 2 = anything else (a token on its own), as in _ROUGH_TOKEN."""
+    if char.isalnum() or char == "_":
+        return 1
+    return 0 if char.isspace() else 2
+
+
+_ASCII_KINDS = np.array([_char_kind(chr(code)) for code in range(128)], dtype=np.uint8)
+
+
+def _rough_token_offsets(text):
+    """Start offsets of the _ROUGH_TOKEN matches in `text`, computed with numpy rather than one match at a time."""
+    codes = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32)
+    ascii_chars = codes < 128
+    kinds = np.empty(len(codes), dtype=np.uint8)
+    kinds[ascii_chars] = _ASCII_KINDS[codes[ascii_chars]]
+    if not ascii_chars.all():
+        unique, inverse = np.unique(codes[~ascii_chars], return_inverse=True)
+        kinds[~ascii_chars] = np.array([_char_kind(chr(code)) for code in unique], dtype=np.uint8)[inverse]
+    word = kinds == 1
+    word_start = word.copy()
+    word_start[1:] &= ~word[:-1]
+    return np.flatnonzero(word_start | (kinds == 2))
+
+
+def token_offsets(text):
+    """
+    Character offset where each token of `text` starts, as a numpy array.
+    Computed from one encode of the whole text, so slicing `text` between
+    two offsets gives spans with an exact token count.
+    """
+    encoding = _get_encoding()
+    if encoding is None:
+        return _rough_token_offsets(text)
+    tokens = np.asarray(encoding.encode_ordinary(text), dtype=np.int64)
+    if not len(tokens):
+        return tokens
+    lengths = _token_byte_lengths(encoding)[tokens]
+    byte_starts = np.cumsum(lengths) - lengths
+    if text.isascii():
+        return byte_starts
+    # Map byte offsets to character offsets: count the UTF-8 lead bytes up to each one
+    data = np.frombuffer(text.encode("utf-8"), dtype=np.uint8)
+    chars_so_far = np.cumsum((data & 0xC0) != 0x80)
+    return chars_so_far[byte_starts] - 1
+
+
+def _sentences(text):
+    return [s.strip() for s in _SENTENCE.findall(text) if s.strip()]
+
+
+# --- CONTEXT ---
+def trim_to_relevant(text, query, max_tokens):
+    """
+    Shrinks a chunk to at most `max_tokens` by keeping the sentences that
+    share the most words with `query` (in their original order, repeats
+    dropped). Chunks that already fit are returned unchanged.
+    """
+    if count_tokens(text) <= max_tokens:
+        return text
+    sentences = list(dict.fromkeys(_sentences(text)))
+    query_terms = set(lexical_terms(query))
+    overlap = [len(query_terms.intersection(lexical_terms(sentence))) for sentence in sentences]
+    scored = sorted(range(len(sentences)), key=lambda i: (-overlap[i], i))
+    # Only sentences sharing a word with the query; for a purely semantic hit, the leading ones
+    lexical = bool(overlap) and overlap[scored[0]] > 0
+    if lexical:
+        scored = [i for i in scored if overlap[i] > 0]
+
+    picked, used = [], 0
+    for i in scored:
+        tokens = count_tokens(sentences[i])
+        if used + tokens > max_tokens:
+            if lexical:
+                continue
+            break
+        picked.append(i)
+        used += tokens
+    if not picked:
+        # Not even the best sentence fits on its own
+        return truncate_tokens(sentences[scored[0]], max_tokens) if sentences else truncate_tokens(text, max_tokens)
+
+    parts = []
+    for n, i in enumerate(sorted(picked)):
+        if n and i != parts[-1][0] + 1:
+            parts.append((None, "..."))
+        parts.append((i, sentences[i]))
+    return " ".join(sentence for _, sentence in parts)
+
+
+def chunk_token_limit():
+    if CHUNK_TOKEN_LIMIT:
+        return CHUNK_TOKEN_LIMIT
+    # Imported here: chunking itself imports this module for token_offsets
+    from chunking import CHUNK_SIZE_TOKENS
+    return CHUNK_SIZE_TOKENS
+
+
+def build_context(results, query, max_tokens):
+    """
+    Context block for `results` [(Document, distance)] within `max_tokens`.
+    Budget left over by short chunks goes to the following ones. The
+    per-chunk cap applies to the content, so a full-size chunk fits whole.
+    """
+    context_text = ""
+    remaining = max_tokens
+    limit = chunk_token_limit()
+    for n, (doc, _) in enumerate(results):
+        source_label = doc.metadata.get('source', 'Unknown')
+        header = f"\n---\n[Source: {source_label}]\nContent: "
+        share = min(limit, remaining // (len(results) - n) - count_tokens(header))
+        if share <= 0:
+            break
+        content = trim_to_relevant(doc.page_content, query, share)
+        block = f"{header}{content}\n"
+        context_text += block
+        remaining -= count_tokens(block)
+    return context_text
+
+
+# --- HISTORY ---
+def _summary_line(message):
+    role = "User" if message['role'] == 'user' else "Assistant"
+    sentences = _sentences(str(message['content']))
+    first = sentences[0] if sentences else ""
+    return f"- {role}: {truncate_tokens(first, SUMMARY_LINE_TOKENS)}"
+
+
+def fold_history(history, summary, budget=HISTORY_TOKEN_BUDGET, max_messages=HISTORY_MAX_MESSAGES):
+    """
+    Splits `history` (oldest first) into the newest messages that fit in
+    `budget` tokens, kept verbatim, and older ones, which are folded into the
+    rolling `summary` as one short line each.
+    Returns (summary, recent, folded) where folded are the messages moved
+    into the summary.
+    """
+    kept, used = 0, 0
+    for message in reversed(history):
+        tokens = count_tokens(str(message['content'])) + 2
+        if kept >= max_messages or used + tokens > budget:
+            break
+        kept += 1
+        used += tokens
+    folded = history[:len(history) - kept]
+    recent = history[len(history) - kept:]
+    if not folded:
+        return summary, recent, []
+
+    lines = (summary.splitlines() if summary else []) + [_summary_line(m) for m in folded]
+    # Oldest lines go first once the summary is over its budget
+    while len(lines) > 1 and count_tokens("\n".join(lines)) > SUMMARY_TOKEN_BUDGET:
+        lines.pop(0)
+    return "\n".join(lines), recent, folded
+
+
+def format_history(history, summary=None, budget=HISTORY_TOKEN_BUDGET):
+    """History block for the prompt: the summary of older turns, then recent messages within `budget`."""
+    summary, recent, _ = fold_history(history, summary, budget)
+    history_text = ""
+    if summary:
+        history_text += f"Summary of earlier conversation:\n{summary}\n\n"
+    for msg in recent:
+        role = "User" if msg['role'] == 'user' else "Assistant"
+        history_text += f"{role}: {msg['content']}\n"
+    return history_text if history_text else "No previous chat history."
@@ -1,14 +1,26 @@
 import os
+import time
+import queue
+import hashlib
 import logging
+import threading
 import numpy as np
-from langchain_community.document_loaders import PyPDFLoader, TextLoader, Docx2txtLoader
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
 from langchain_openai import OpenAIEmbeddings, ChatOpenAI
 from langchain_google_genai import GoogleGenerativeAIEmbeddings, ChatGoogleGenerativeAI
-from langchain_community.vectorstores import FAISS
-from langchain_classic.text_splitter import RecursiveCharacterTextSplitter
 from langchain_classic.prompts import PromptTemplate
 
-from langchain_classic.schema import Document
+from embedding_cache import EmbeddingCache, make_cache_key, normalize_text
+from answer_cache import AnswerCache
+from local_models import HashingEmbeddings, EchoChatModel
+from client_pool import ClientPool, hash_api_key, make_http_client, OPENAI_BASE_URL, GEMINI_BASE_URL
+from metrics import start_timings, INGESTED_FILES, INGESTED_CHUNKS
+from batching import MicroBatcher, MICRO_BATCHING
+from prompt_builder import count_tokens, build_context, format_history, PROMPT_TOKEN_BUDGET, HISTORY_TOKEN_BUDGET
+from parsing import parse_files
+from chunking import split_documents
+from vector_store import SegmentedStore, chunk_id
+from embed_scheduler import EmbedScheduler, EmbedCheckpoint, EMBED_BATCH_SIZE, EMBED_MAX_BATCH, CHECKPOINT_FILE
 
 # Setup Logging
 logging.basicConfig(level=logging.INFO)
@@ -17,24 +29,118 @@ logger = logging.getLogger(__name__)
 # Folder to save the database
 DB_PATH = "faiss_db_store"
 
+# Max batches waiting between the parse/split stage and the embed stage
+INGEST_QUEUE_BATCHES = int(os.getenv("RAG_INGEST_QUEUE_BATCHES", 4))
+
+# Query expansion: "local" (BM25 co-occurrence terms), "llm" (local plus LLM
+# variations run concurrently), "off"
+QUERY_EXPANSION = os.getenv("RAG_QUERY_EXPANSION", "local")
+# Max seconds retrieval waits for LLM variations before going on without them
+LLM_EXPANSION_TIMEOUT = float(os.getenv("RAG_LLM_EXPANSION_TIMEOUT", 1.5))
+# BM25 hits fused with the vector hits, and the top ones used as expansion feedback
+LEXICAL_K = 8
+FEEDBACK_DOCS = 5
+# Reciprocal rank fusion constant (standard value from the RRF paper)
+RRF_K = 60
+
+# Embedding model per provider (also part of the embedding cache key)
+EMBEDDING_MODELS = {
+    "openai": "text-embedding-3-small",
+    "gemini": "gemini-embedding-001",
+    "local": "local-hashing",
+}
+# Chat model per provider
+LLM_MODELS = {
+    "openai": "gpt-4o-mini",
+    "gemini": "gemini-2.5-flash",
+    "local": "local-echo",
+}
+
+def new_progress():
+    """Counters process_files keeps up to date while it runs."""
+    return {
+        "files_received": 0, "files_parsed": 0, "files_skipped": 0, "files_failed": 0,
+        "chunks_queued": 0, "chunks_embedded": 0, "chunks_resumed": 0, "errors": []
+    }
+
 class RAGManager:
-    def __init__(self):
+    def __init__(self, parse_workers=None, index_type=None):
         self.vector_store = None
+        # None -> parsing.PARSE_WORKERS
+        self.parse_workers = parse_workers
+        # None -> vector_store.INDEX_TYPE ("auto": flat until the ANN threshold)
+        self.index_type = index_type
+        self.embedding_cache = EmbeddingCache()
+        self.answer_cache = AnswerCache()
+        # Provider clients are reused across requests (keep-alive connections)
+        self.clients = ClientPool()
+        # Runs optional LLM query expansion beside retrieval
+        self.expansion_pool = ThreadPoolExecutor(max_workers=4)
+        # Concurrent first requests load the store once
+        self._load_lock = threading.Lock()
+        # Vectors of ingestions that failed before their commit (opened with the store)
+        self.embed_checkpoint = None
+        # Query embeddings and index searches of concurrent requests are batched together
+        self.embed_batcher = MicroBatcher("embed", self._embed_batch) if MICRO_BATCHING else None
+        self.search_batcher = MicroBatcher("search", self._search_batch) if MICRO_BATCHING else None
 
-    def _get_embeddings(self, provider, api_key):
+    def _build_embeddings(self, provider, api_key, ingest=False):
+        """
+        (client, resources) for `provider`. Ingestion clients send each batch
+        as one request and leave retries to the EmbedScheduler.
+        """
+        model = EMBEDDING_MODELS.get(provider)
         if provider == "openai":
-            return OpenAIEmbeddings(model="text-embedding-3-small", openai_api_key=api_key)
+            http_client = make_http_client()
+            if ingest:
+                return OpenAIEmbeddings(
+                    model=model, openai_api_key=api_key, base_url=OPENAI_BASE_URL, http_client=http_client,
+                    max_retries=0, chunk_size=EMBED_MAX_BATCH, check_embedding_ctx_length=False
+                ), [http_client]
+            return OpenAIEmbeddings(model=model, openai_api_key=api_key, base_url=OPENAI_BASE_URL, http_client=http_client), [http_client]
         elif provider == "gemini":
-            return GoogleGenerativeAIEmbeddings(model="gemini-embedding-001", google_api_key=api_key)
-        return None
+            return GoogleGenerativeAIEmbeddings(model=model, google_api_key=api_key, base_url=GEMINI_BASE_URL), []
+        elif provider == "local":
+            return HashingEmbeddings(), []
+        return None, []
+
+    def _get_embeddings(self, provider, api_key):
+        """Lease on the pooled query embeddings client: `with self._get_embeddings(...) as embeddings:`."""
+        model = EMBEDDING_MODELS.get(provider)
+        return self.clients.lease(
+            ("embeddings", provider, model, hash_api_key(api_key), None),
+            lambda: self._build_embeddings(provider, api_key)
+        )
+
+    def _get_embed_scheduler(self, provider, api_key):
+        """Lease on the provider's EmbedScheduler, held for a whole ingestion."""
+        model = EMBEDDING_MODELS.get(provider)
+
+        def build():
+            embeddings, resources = self._build_embeddings(provider, api_key, ingest=True)
+            if embeddings is None:
+                return None, resources
+            scheduler = EmbedScheduler(embeddings, provider)
+            return scheduler, resources + [scheduler]
+
+        return self.clients.lease(("embed_scheduler", provider, model, hash_api_key(api_key), None), build)
     
     def _get_llm(self, provider, api_key, temperature=0.3):
+        """Lease on the pooled chat model client (see _get_embeddings)."""
         # Temperature 0.3 allows for better synthesis of definitions
-        if provider == "openai":
-            return ChatOpenAI(model="gpt-4o-mini", temperature=temperature, openai_api_key=api_key)
-        elif provider == "gemini":
-            return ChatGoogleGenerativeAI(model="gemini-2.5-flash", temperature=temperature, google_api_key=api_key)
-        return None
+        model = LLM_MODELS.get(provider)
+
+        def build():
+            if provider == "openai":
+                http_client = make_http_client()
+                return ChatOpenAI(model=model, temperature=temperature, openai_api_key=api_key, base_url=OPENAI_BASE_URL, http_client=http_client), [http_client]
+            elif provider == "gemini":
+                return ChatGoogleGenerativeAI(model=model, temperature=temperature, google_api_key=api_key, base_url=GEMINI_BASE_URL), []
+            elif provider == "local":
+                return EchoChatModel(), []
+            return None, []
+
+        return self.clients.lease(("llm", provider, model, hash_api_key(api_key), temperature), build)
 
     def _calculate_confidence(self, distance):
         """
@@ -49,74 +155,383 @@ class RAGManager:
         except:
             return 0.0
 
-    def _format_history(self, history_list):
-        history_text = ""
+    def _format_history(self, history_list, summary=None, budget=HISTORY_TOKEN_BUDGET):
+        # Recent messages verbatim within `budget` tokens, older ones only through the summary
+        return format_history(history_list, summary, budget)
+
+    def _history_key(self, history_list, summary=None):
+        """
+        Hash of the conversation a question is asked in (None for a new one).
+        The answer depends on it, so cached answers are only shared within it.
+        """
+        if not history_list and not summary:
+            return None
+        digest = hashlib.sha256((summary or "").encode("utf-8"))
         for msg in history_list:
-            role = "User" if msg['role'] == 'user' else "Assistant"
-            content = str(msg['content'])
-            history_text += f"{role}: {content}\n"
-        return history_text if history_text else "No previous chat history."
+            digest.update(f"\x00{msg['role']}\x00{msg['content']}".encode("utf-8"))
+        return digest.hexdigest()
+
+    def _embed_queries(self, queries, embeddings, provider):
+        """
+        Returns one float32 row per query, served from the embedding cache when possible.
+        All cache misses are embedded together in a single provider call.
+        """
+        model = EMBEDDING_MODELS.get(provider, "unknown")
+        keys = [make_cache_key(provider, model, q) for q in queries]
+        vectors = [self.embedding_cache.get(key) for key in keys]
+
+        missing = [i for i, v in enumerate(vectors) if v is None]
+        if missing:
+            texts = [normalize_text(queries[i]) for i in missing]
+            if self.embed_batcher is not None:
+                fresh = self.embed_batcher.submit((provider, id(embeddings)), (embeddings, texts))
+            else:
+                fresh = embeddings.embed_documents(texts)
+            for i, vector in zip(missing, fresh):
+                self.embedding_cache.put(keys[i], vector)
+                vectors[i] = vector
+
+        return np.asarray(vectors, dtype=np.float32)
+
+    def _embed_batch(self, key, items):
+        """MicroBatcher fn: one provider call for the query texts of several requests (same client)."""
+        embeddings = items[0][0]
+        unique = list(dict.fromkeys(text for _, texts in items for text in texts))
+        vector_of = dict(zip(unique, embeddings.embed_documents(unique)))
+        return [[vector_of[text] for text in texts] for _, texts in items]
+
+    def _search_batch(self, key, query_matrices):
+        """MicroBatcher fn: one index search for several requests with the same snapshot and access scope."""
+        store, snapshot, scope, k = key
+        return store.search_ids_batch(query_matrices, scope, k, snapshot)
+
+    def _get_store(self, provider, api_key):
+        """The loaded store, loading it on first use (once, however many requests arrive together)."""
+        if self.vector_store is None:
+            with self._load_lock:
+                if self.vector_store is None:
+                    self.load_existing_db(provider, api_key)
+        return self.vector_store
 
     def load_existing_db(self, provider, api_key):
-        if os.path.exists(DB_PATH):
-            embeddings = self._get_embeddings(provider, api_key)
-            try:
-                self.vector_store = FAISS.load_local(DB_PATH, embeddings, allow_dangerous_deserialization=True)
+        try:
+            self.vector_store = SegmentedStore.load(DB_PATH, index_type=self.index_type)
+            if self.vector_store:
                 print("✅ Database loaded successfully.")
-            except Exception as e:
-                print(f"⚠️ Database load error: {e}")
-                self.vector_store = None
+        except Exception as e:
+            print(f"⚠️ Database load error: {e}")
+            self.vector_store = None
 
-    def process_files(self, file_paths, username, privacy, provider, api_key):
-        documents = []
-        for file_path in file_paths:
-            file_name = os.path.basename(file_path)
+    def collect_metrics(self):
+        """Scrape-time metric families (see metrics.Registry.collector)."""
+        embed_stats = self.embedding_cache.stats()
+        answer_stats = self.answer_cache.stats()
+        client_stats = self.clients.stats()
+        families = [
+            ("rag_embedding_cache_lookups_total", "counter", "Query embedding cache lookups by result.", [
+                ({"result": "memory_hit"}, embed_stats["memory_hits"]),
+                ({"result": "disk_hit"}, embed_stats["disk_hits"]),
+                ({"result": "miss"}, embed_stats["misses"]),
+            ]),
+            ("rag_embedding_cache_hit_rate", "gauge", "Share of query embeddings served from cache.", [({}, embed_stats["hit_rate"])]),
+            ("rag_answer_cache_lookups_total", "counter", "Answer cache lookups by result.", [
+                ({"result": "hit"}, answer_stats["hits"]),
+                ({"result": "miss"}, answer_stats["misses"]),
+            ]),
+            ("rag_answer_cache_hit_rate", "gauge", "Share of questions answered from the answer cache.", [({}, answer_stats["hit_rate"])]),
+            ("rag_answer_cache_items", "gauge", "Answers currently cached.", [({}, answer_stats["items"])]),
+            ("rag_provider_clients", "gauge", "Provider clients kept alive in the pool.", [({}, client_stats["clients"])]),
+        ]
+        store = self.vector_store
+        if store is not None:
+            families += [
+                ("rag_index_vectors", "gauge", "Live (searchable) vectors in the index.", [({}, len(store))]),
+                ("rag_index_segments", "gauge", "Index segments on disk.", [({}, len(store.segments))]),
+                ("rag_index_tombstones", "gauge", "Deleted vectors not yet compacted away.", [({}, len(store.tombstones))]),
+                ("rag_index_version", "gauge", "Index version (bumped by every ingestion).", [({}, store.version)]),
+            ]
+        return families
+
+    def index_report(self, k=10):
+        """Recall-vs-latency of the approximate index segments against exact search."""
+        if not self._get_store(None, None):
+            return []
+        return self.vector_store.recall_report(k=k)
+
+    def _file_hash(self, file_path):
+        digest = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def _put_batch(self, batches, item, stop):
+        """Blocking put on the bounded queue that gives up once `stop` is set."""
+        while not stop.is_set():
             try:
-                if file_path.endswith(".pdf"):
-                    loader = PyPDFLoader(file_path)
-                elif file_path.endswith(".docx"):
-                    loader = Docx2txtLoader(file_path)
-                else:
-                    loader = TextLoader(file_path)
-                
-                docs = loader.load()
-                for doc in docs:
-                    doc.metadata["source"] = file_name
-                    doc.metadata["owner"] = username
-                    doc.metadata["privacy"] = privacy
-                documents.extend(docs)
-            except Exception as e:
-                print(f"❌ Error processing {file_name}: {e}")
+                batches.put(item, timeout=0.5)
+                return True
+            except queue.Full:
                 continue
+        return False
+
+    def _produce_batches(self, file_paths, username, privacy, batches, stop, state, timings, progress):
+        """
+        Producer half of process_files: hash -> parse -> split. Chunks that still
+        need embedding are put on `batches` in groups of EMBED_BATCH_SIZE, while
+        the manifest bookkeeping is collected in `state` and per-file counts in
+        `progress`. The EmbedScheduler re-batches them to its adaptive size.
+        """
+        # Decisions (skip, reuse, tombstone) are all made against the version ingestion started from
+        snapshot = state["snapshot"]
+        file_hashes = {}
+        batch_refs, batch_splits = [], []
 
-        if not documents:
-            return 0
+        def files_to_parse():
+            # Hash first: unchanged files are never sent to the parser
+            for file_path in file_paths:
+                file_name = os.path.basename(file_path)
+                progress["files_received"] += 1
+                entry = snapshot.sources.get(f"{username}/{file_name}")
+                try:
+                    with timings.span("hash"):
+                        file_hash = self._file_hash(file_path)
+                except Exception as e:
+                    print(f"❌ Error processing {file_name}: {e}")
+                    INGESTED_FILES.inc(status="failed")
+                    progress["files_failed"] += 1
+                    progress["errors"].append(f"{file_name}: {e}")
+                    continue
+                if entry and entry["file_hash"] == file_hash and entry["privacy"] == privacy:
+                    print(f"⏭️ Skipping unchanged file {file_name}")
+                    INGESTED_FILES.inc(status="skipped")
+                    progress["files_skipped"] += 1
+                    state["total_chunks"] += len(entry["chunks"])
+                    continue
+                file_hashes[file_path] = file_hash
+                yield file_path
+
+        try:
+            # Files arrive here already split (in the parse workers), in completion order
+            parsed = parse_files(files_to_parse(), workers=self.parse_workers, split=split_documents)
+            for file_path, docs, error in parsed:
+                if stop.is_set():
+                    return
+                file_name = os.path.basename(file_path)
+                if error is not None:
+                    print(f"❌ Error processing {file_name}: {error}")
+                    INGESTED_FILES.inc(status="failed")
+                    progress["files_failed"] += 1
+                    progress["errors"].append(f"{file_name}: {error}")
+                    continue
+                source_key = f"{username}/{file_name}"
+                entry = state["updated_sources"].get(source_key) or snapshot.sources.get(source_key)
+                old_chunks = entry["chunks"] if entry else {}
 
-        # Chunk Size: 1000 chars is optimal
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-        splits = text_splitter.split_documents(documents)
+                chunks = {}
+                for split in docs:
+                    split.metadata["source"] = file_name
+                    split.metadata["owner"] = username
+                    split.metadata["privacy"] = privacy
+                    chunks.setdefault(chunk_id(username, file_name, split.page_content), split)
+                del docs
 
-        embeddings = self._get_embeddings(provider, api_key)
+                # chunk hash -> vector id; None marks chunks that get a new vector
+                entry_chunks = {}
+                reused = 0
+                for chunk_hash, split in chunks.items():
+                    vector_id = old_chunks.get(chunk_hash)
+                    if vector_id is not None and vector_id not in snapshot.tombstones:
+                        if entry["privacy"] == privacy:
+                            entry_chunks[chunk_hash] = vector_id
+                            reused += 1
+                        else:
+                            # Same text, new privacy: reuse the stored vector under a new id
+                            state["moved"].append((source_key, chunk_hash, vector_id, split))
+                            entry_chunks[chunk_hash] = None
+                        continue
 
+                    entry_chunks[chunk_hash] = None
+                    progress["chunks_queued"] += 1
+                    batch_refs.append((source_key, chunk_hash))
+                    batch_splits.append(split)
+                    if len(batch_refs) >= EMBED_BATCH_SIZE:
+                        if not self._put_batch(batches, (batch_refs, batch_splits), stop):
+                            return
+                        batch_refs, batch_splits = [], []
+
+                state["tombstones"].extend(v for h, v in old_chunks.items() if h not in chunks and v is not None)
+                state["updated_sources"][source_key] = {
+                    "file_hash": file_hashes[file_path], "privacy": privacy, "chunks": entry_chunks
+                }
+                state["total_chunks"] += len(chunks)
+                INGESTED_FILES.inc(status="indexed")
+                progress["files_parsed"] += 1
+                INGESTED_CHUNKS.inc(reused, kind="reused")
+
+            if batch_refs:
+                self._put_batch(batches, (batch_refs, batch_splits), stop)
+        except Exception as e:
+            state["error"] = e
+        finally:
+            self._put_batch(batches, None, stop)
+
+    def process_files(self, file_paths, username, privacy, provider, api_key, progress=None):
+        """
+        Streaming, incremental ingestion: load -> split -> embed -> add.
+        Parsing runs in a producer thread and hands chunks over a bounded queue,
+        so later files are parsed while earlier batches are being embedded, and
+        embedded chunks are flushed to disk every INGEST_FLUSH_CHUNKS, so
+        memory stays flat regardless of upload size. `file_paths` may be any
+        iterable, including a generator that saves uploads lazily.
+
+        Files whose hash is unchanged are skipped without parsing, and only
+        chunks whose content is new get embedded, by the provider's
+        EmbedScheduler (concurrent batches within its rate limits). Their
+        vectors are checkpointed, so after a failed upload sending the same
+        files again resumes where it stopped. Chunks that disappeared from
+        a re-uploaded file are tombstoned. The result is published as new index
+        segments in one commit, so the cost of a save is proportional to the upload.
+        Returns the number of chunks the uploaded files consist of.
+
+        `progress` (optional dict, see new_progress) is updated in place as
+        files are parsed and chunks embedded, so another thread can report it.
+        """
+        if progress is None:
+            progress = new_progress()
+        # Leased so the pool never closes the scheduler mid-upload, however long it runs
+        with self._get_embed_scheduler(provider, api_key) as scheduler:
+            return self._ingest(scheduler, file_paths, username, privacy, provider, api_key, progress)
+
+    def _ingest(self, scheduler, file_paths, username, privacy, provider, api_key, progress):
+        """The body of process_files, run while its EmbedScheduler is leased."""
+        timings = start_timings("ingest")
+        model = EMBEDDING_MODELS.get(provider)
         if self.vector_store is None:
-            if os.path.exists(DB_PATH):
-                try:
-                    self.vector_store = FAISS.load_local(DB_PATH, embeddings, allow_dangerous_deserialization=True)
-                    self.vector_store.add_documents(splits)
-                except:
-                    self.vector_store = FAISS.from_documents(splits, embeddings)
-            else:
-                self.vector_store = FAISS.from_documents(splits, embeddings)
-        else:
-            self.vector_store.add_documents(splits)
-        
-        self.vector_store.save_local(DB_PATH)
-        return len(splits)
+            with timings.span("load"):
+                self._get_store(provider, api_key)
+        if self.vector_store is None:
+            raise RuntimeError("Vector database could not be loaded.")
+        if self.embed_checkpoint is None:
+            with self._load_lock:
+                if self.embed_checkpoint is None:
+                    os.makedirs(DB_PATH, exist_ok=True)
+                    self.embed_checkpoint = EmbedCheckpoint(os.path.join(DB_PATH, CHECKPOINT_FILE))
+
+        state = {
+            "total_chunks": 0, "updated_sources": {}, "tombstones": [], "moved": [], "error": None,
+            "snapshot": self.vector_store.ingest_snapshot()
+        }
+        batches = queue.Queue(maxsize=INGEST_QUEUE_BATCHES)
+        stop = threading.Event()
+        producer = threading.Thread(
+            target=self._produce_batches,
+            args=(file_paths, username, privacy, batches, stop, state, timings, progress),
+            daemon=True
+        )
+        producer.start()
+
+        def queued_chunks():
+            while True:
+                # Time spent waiting here means embedding outpaces parsing
+                with timings.span("queue_wait"):
+                    item = batches.get()
+                if item is None:
+                    return
+                for ref, split in zip(*item):
+                    yield ref[1], split.page_content, (ref, split)
+
+        # Spills its chunks to disk as it fills, so only their refs stay in memory
+        builder = self.vector_store.new_builder()
+        try:
+            try:
+                for payloads, vectors, resumed in scheduler.embed(queued_chunks(), model, self.embed_checkpoint, timings):
+                    refs, splits = zip(*payloads)
+                    builder.add(list(refs), vectors, list(splits))
+                    INGESTED_CHUNKS.inc(len(splits), kind="resumed" if resumed else "embedded")
+                    progress["chunks_embedded"] += len(splits)
+                    if resumed:
+                        progress["chunks_resumed"] += len(splits)
+            finally:
+                stop.set()
+                producer.join()
+
+            if state["error"] is not None:
+                raise state["error"]
+            if len(builder):
+                resumed = f" ({progress['chunks_resumed']} resumed from a failed upload)" if progress["chunks_resumed"] else ""
+                print(f"🧮 Embedded {len(builder)} new chunks{resumed}")
+
+            if state["moved"]:
+                old_ids = [vector_id for _, _, vector_id, _ in state["moved"]]
+                builder.add(
+                    [(source_key, chunk_hash) for source_key, chunk_hash, _, _ in state["moved"]],
+                    self.vector_store.reconstruct(old_ids, state["snapshot"]),
+                    [split for _, _, _, split in state["moved"]]
+                )
+                state["tombstones"].extend(old_ids)
+                INGESTED_CHUNKS.inc(len(old_ids), kind="moved")
+
+            if state["updated_sources"]:
+                with timings.span("commit"):
+                    self.vector_store.commit(builder, state["updated_sources"], state["tombstones"])
+                # Committed vectors are in the index now
+                self.embed_checkpoint.delete(model, [chunk_hash for _, chunk_hash in builder.refs])
+                # Cached answers are keyed on the old index version and can never match again
+                self.answer_cache.clear()
+        finally:
+            builder.discard()
+        timings.finish()
+        return state["total_chunks"]
+
+    # --- DOCUMENT MANAGEMENT ---
+    def list_documents(self, username):
+        """The files `username` has uploaded: [{"source", "privacy", "chunks"}]."""
+        store = self._get_store(None, None)
+        if store is None:
+            return []
+        store.refresh()
+        prefix = f"{username}/"
+        return [
+            {"source": key[len(prefix):], "privacy": entry["privacy"], "chunks": len(entry["chunks"])}
+            for key, entry in sorted(store.sources.items()) if key.startswith(prefix)
+        ]
+
+    def delete_documents(self, file_names, username):
+        """
+        Deletes files uploaded by `username` from the index. Their vectors are
+        tombstoned (filtered from every search at once) and reclaimed later by
+        incremental compaction. Returns {file_name: chunks deleted} for the
+        files that existed.
+        """
+        store = self._get_store(None, None)
+        if store is None:
+            return {}
+        deleted = store.delete_sources([f"{username}/{file_name}" for file_name in file_names])
+        if deleted:
+            self.answer_cache.clear()
+            print(f"🗑️ Deleted {len(deleted)} files ({sum(deleted.values())} chunks) for user '{username}'")
+        return {key.split("/", 1)[1]: count for key, count in deleted.items()}
+
+    def replace_document(self, file_path, username, privacy, provider, api_key, replaces=None, progress=None):
+        """
+        Replaces a file with a new version. Under the same name this is an
+        incremental re-upload: unchanged chunks keep their vectors, removed ones
+        are tombstoned. `replaces` names an older file to delete once the new
+        one is indexed, so the content is never missing in between.
+        Returns the number of chunks of the new version.
+        """
+        total_chunks = self.process_files([file_path], username, privacy, provider, api_key, progress=progress)
+        if replaces and replaces != os.path.basename(file_path):
+            self.delete_documents([replaces], username)
+        return total_chunks
 
     # --- THIS WAS MISSING BEFORE ---
-    def _generate_query_variations(self, original_query, llm):
+    def _generate_query_variations(self, original_query, provider, api_key):
         """
         Generates synonyms/variations to improve search recall.
+        Takes its own client lease: the request stops waiting after
+        LLM_EXPANSION_TIMEOUT while this call may still be running.
         """
         prompt = PromptTemplate(
             input_variables=["question"],
@@ -125,61 +540,124 @@ class RAGManager:
             Keep it simple. Return only the questions separated by newlines."""
         )
         try:
-            response = llm.invoke(prompt.format(question=original_query))
+            with self._get_llm(provider, api_key, temperature=0.3) as llm:
+                response = llm.invoke(prompt.format(question=original_query))
             variations = response.content.split('\n')
             cleaned = [v.strip() for v in variations if v.strip()]
             return cleaned[:2] 
         except:
             return [original_query]
 
-    def get_answer(self, query, history, username, provider, api_key):
-        embeddings = self._get_embeddings(provider, api_key)
-        llm = self._get_llm(provider, api_key, temperature=0.3)
-        
+    def _fuse(self, query_vector, vector_ids, vector_distances, lexical_hits, snapshot, limit=8):
+        """
+        Reciprocal rank fusion of the vector ranking and the BM25 ranking.
+        Returns [(Document, distance)] in fused order; chunks found only
+        lexically get their real vector distance so confidence stays comparable.
+        """
+        scores = {}
+        for ranking in (vector_ids.tolist(), [vector_id for vector_id, _ in lexical_hits]):
+            for rank, vector_id in enumerate(ranking):
+                scores[vector_id] = scores.get(vector_id, 0.0) + 1.0 / (RRF_K + rank + 1)
+        fused = sorted(scores, key=scores.get, reverse=True)[:limit]
+
+        distance_of = dict(zip(vector_ids.tolist(), vector_distances.tolist()))
+        missing = [vector_id for vector_id in fused if vector_id not in distance_of]
+        distance_of.update(zip(missing, self.vector_store.distances(query_vector, missing, snapshot).tolist()))
+        return self.vector_store.resolve(fused, [distance_of[vector_id] for vector_id in fused])
+
+    def _prepare_answer(self, query, history, username, provider, api_key, embeddings, timings, history_summary=None):
+        """
+        Runs retrieval and builds the final prompt (steps 1-3 of get_answer).
+        Returns either a finished result dict (nothing to ask the LLM) or a
+        dict with the prompt and the retrieval results. The caller holds the
+        lease on `embeddings` (and on the LLM) until the answer is done.
+
+        Every read goes to one store snapshot, so a concurrent ingestion can't
+        mix versions within an answer; its version is returned as index_version.
+        """
         if self.vector_store is None:
-            self.load_existing_db(provider, api_key)
+            with timings.span("load"):
+                self._get_store(provider, api_key)
 
-        if not self.vector_store:
-            return {"answer": "⚠️ Database is empty.", "sources": [], "confidence": 0.0}
+        store = self.vector_store
+        if store is None:
+            return {"answer": "⚠️ Database is empty.", "sources": [], "confidence": 0.0, "index_version": 0}
+        # Picks up ingestions by other processes (one stat() when there are none)
+        store.refresh()
+        snapshot = store.snapshot()
+        if not snapshot:
+            return {"answer": "⚠️ Database is empty.", "sources": [], "confidence": 0.0, "index_version": snapshot.version}
+
+        # --- STEP 0: ANSWER CACHE ---
+        # Same question (by embedding), same visible documents, same index version, same conversation
+        with timings.span("cache"):
+            query_vector = self._embed_queries([query], embeddings, provider)[0]
+            cache_scope = (
+                provider, store.access_scope(username, snapshot), snapshot.version,
+                self._history_key(history, history_summary)
+            )
+            cached = self.answer_cache.get(cache_scope, query_vector)
+        if cached is not None:
+            return cached
 
         # --- STEP 1: SEARCH ---
+        short_query = len(query.split()) < 10
+        llm_variations = None
+        if QUERY_EXPANSION == "llm" and short_query:
+            # Started first so the LLM round trip overlaps with local retrieval
+            llm_variations = self.expansion_pool.submit(self._generate_query_variations, query, provider, api_key)
+
+        # Access control happens inside both searches, so every hit is visible to the user
+        with timings.span("lexical"):
+            lexical_hits = store.lexical_search(query, username, k=LEXICAL_K, snapshot=snapshot)
+
         queries_to_search = [query]
-        if len(query.split()) < 10:
-            variations = self._generate_query_variations(query, llm)
-            queries_to_search.extend(variations)
-
-        unique_docs = {}
-        for q in queries_to_search:
-            docs_and_scores = self.vector_store.similarity_search_with_score(q, k=4)
-            for doc, distance in docs_and_scores:
-                doc_owner = doc.metadata.get("owner", "unknown")
-                doc_privacy = doc.metadata.get("privacy", "private")
-                has_access = (doc_owner == username) or (doc_privacy == "public")
-                
-                if has_access:
-                    content_hash = hash(doc.page_content)
-                    if content_hash not in unique_docs:
-                        unique_docs[content_hash] = (doc, distance)
-                    else:
-                        if distance < unique_docs[content_hash][1]:
-                            unique_docs[content_hash] = (doc, distance)
-
-        results = list(unique_docs.values())
-        results.sort(key=lambda x: x[1])
+        if QUERY_EXPANSION != "off" and short_query:
+            with timings.span("expansion"):
+                terms = store.chunks.expansion_terms(query, [v for v, _ in lexical_hits[:FEEDBACK_DOCS]])
+            if terms:
+                queries_to_search.append(f"{query} {' '.join(terms)}")
+        if llm_variations is not None:
+            with timings.span("variations"):
+                try:
+                    queries_to_search.extend(llm_variations.result(timeout=LLM_EXPANSION_TIMEOUT))
+                except FutureTimeout:
+                    pass
+
+        with timings.span("embed"):
+            query_matrix = self._embed_queries(queries_to_search, embeddings, provider)
+        with timings.span("search"):
+            if self.search_batcher is not None:
+                # Keyed on the access scope, so users who see the same documents share a search
+                vector_ids, vector_distances = self.search_batcher.submit((store, snapshot, cache_scope[1], 4), query_matrix)
+            else:
+                vector_ids, vector_distances = store.search_ids(query_matrix, username, k=4, snapshot=snapshot)
+        with timings.span("fusion"):
+            candidates = self._fuse(query_vector, vector_ids, vector_distances, lexical_hits, snapshot)
+        prompt_start = time.perf_counter()
+
+        results = []
+        seen_content = set()
+        for doc, distance in candidates:
+            # Candidates are sorted by fused rank, so the first copy of a text is the best one
+            content_hash = hash(doc.page_content)
+            if content_hash not in seen_content:
+                seen_content.add(content_hash)
+                results.append((doc, distance))
+
         top_results = results[:3]
 
         if not top_results:
-             return {"answer": "I couldn't find relevant info.", "sources": [], "confidence": 0.0}
+             return {"answer": "I couldn't find relevant info.", "sources": [], "confidence": 0.0, "index_version": snapshot.version}
 
         # --- STEP 2: SCORES ---
-        best_distance = float(top_results[0][1])
+        best_distance = min(float(distance) for _, distance in top_results)
         try:
             score_val = 1.0 / (1.0 + (best_distance * 0.3))
             confidence = float(round(score_val * 100, 2))
         except:
             confidence = 0.0
         
-        context_text = ""
         sources = []
         for doc, dist in top_results:
             try:
@@ -189,14 +667,11 @@ class RAGManager:
                 s_score = 0.0
                 
             source_label = doc.metadata.get('source', 'Unknown')
-            context_text += f"\n---\n[Source: {source_label}]\nContent: {doc.page_content}\n"
             sources.append({"source": source_label, "content": doc.page_content, "score": s_score})
 
         avg_precision = sum([s['score'] for s in sources]) / len(sources) if sources else 0.0
 
         # --- STEP 3: PROMPT ---
-        formatted_history = self._format_history(history)
-        
         prompt_template = """
         You are a smart Corporate RAG Assistant. 
         Your goal is to answer the user's question using the Context provided.
@@ -219,14 +694,26 @@ class RAGManager:
         """
         
         prompt = PromptTemplate(template=prompt_template, input_variables=["history", "context", "question"])
+
+        # Token budget: instructions and question are fixed, history gets at most
+        # half of what is left, and the context (trimmed to relevant sentences) the rest
+        fixed_tokens = count_tokens(prompt.format(history="", context="", question=query))
+        available = max(PROMPT_TOKEN_BUDGET - fixed_tokens, 0)
+        formatted_history = self._format_history(history, history_summary, min(HISTORY_TOKEN_BUDGET, available // 2))
+        context_text = build_context(top_results, query, available - count_tokens(formatted_history))
         final_prompt = prompt.format(history=formatted_history, context=context_text, question=query)
-        
-        try:
-            response = llm.invoke(final_prompt)
-            answer_text = response.content
-        except Exception as e:
-            answer_text = f"Error from LLM: {str(e)}"
+        timings.add("prompt", time.perf_counter() - prompt_start)
 
+        return {
+            "cache_key": (cache_scope, query_vector),
+            "prompt": final_prompt,
+            "sources": sources,
+            "confidence": confidence,
+            "avg_precision": avg_precision,
+            "index_version": snapshot.version,
+        }
+
+    def _finish_answer(self, answer_text, sources, confidence, avg_precision):
         # --- STEP 4: SMART OVERRIDE ---
         # If the LLM says it can't find info, force confidence to 0
         keywords = ["cannot find", "no information", "not mentioned", "does not contain"]
@@ -242,3 +729,80 @@ class RAGManager:
             "retrieval_quality": float(round(avg_precision, 2))
         }
 
+    def _complete_answer(self, prepared, answer_text, failed):
+        result = self._finish_answer(answer_text, prepared["sources"], prepared["confidence"], prepared["avg_precision"])
+        # The index version the answer was retrieved from
+        result["index_version"] = prepared["index_version"]
+        if not failed:
+            self.answer_cache.put(*prepared["cache_key"], result)
+        return result
+
+    def get_answer(self, query, history, username, provider, api_key, include_timings=False, history_summary=None):
+        """
+        Answers `query` from the user's visible documents.
+        With include_timings=True the result carries a `timings` dict of
+        per-stage durations in milliseconds. `history_summary` summarises the
+        turns older than `history` (see database.get_chat_context).
+        """
+        timings = start_timings("answer", include_timings)
+        with self._get_embeddings(provider, api_key) as embeddings, self._get_llm(provider, api_key) as llm:
+            prepared = self._prepare_answer(query, history, username, provider, api_key, embeddings, timings, history_summary)
+            if "prompt" not in prepared:
+                result = prepared
+            else:
+                failed = False
+                try:
+                    with timings.span("llm"):
+                        response = llm.invoke(prepared["prompt"])
+                    answer_text = response.content
+                except Exception as e:
+                    answer_text = f"Error from LLM: {str(e)}"
+                    failed = True
+                result = self._complete_answer(prepared, answer_text, failed)
+
+        stage_timings = timings.finish()
+        return dict(result, timings=stage_timings) if include_timings else result
+
+    def stream_answer(self, query, history, username, provider, api_key, include_timings=False, history_summary=None):
+        """
+        Streaming variant of get_answer.
+        Yields {"type": "token", "content": ...} frames as the LLM generates,
+        then one {"type": "final", ...} frame holding the same fields as
+        get_answer's result (the smart override has run by then).
+        """
+        timings = start_timings("answer_stream", include_timings)
+        # The leases last until the generator finishes (or is closed by a disconnecting client)
+        with self._get_embeddings(provider, api_key) as embeddings, self._get_llm(provider, api_key) as llm:
+            prepared = self._prepare_answer(query, history, username, provider, api_key, embeddings, timings, history_summary)
+            if "prompt" not in prepared:
+                stage_timings = timings.finish()
+                result = dict(prepared, timings=stage_timings) if include_timings else prepared
+                yield {"type": "token", "content": result["answer"]}
+                yield dict(result, type="final")
+                return
+
+            parts = []
+            failed = False
+            llm_start = time.perf_counter()
+            try:
+                for chunk in llm.stream(prepared["prompt"]):
+                    if chunk.content:
+                        if not parts:
+                            timings.mark("first_token")
+                        parts.append(chunk.content)
+                        yield {"type": "token", "content": chunk.content}
+                answer_text = "".join(parts)
+            except Exception as e:
+                error_text = f"Error from LLM: {str(e)}"
+                yield {"type": "token", "content": error_text}
+                answer_text = "".join(parts) + error_text
+                failed = True
+
+            timings.add("llm", time.perf_counter() - llm_start)
+
+        result = self._complete_answer(prepared, answer_text, failed)
+        stage_timings = timings.finish()
+        if include_timings:
+            result = dict(result, timings=stage_timings)
+        yield dict(result, type="final")
+
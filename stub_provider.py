@@ -0,0 +1,145 @@
+"""
+OpenAI-compatible embeddings stub for testing ingestion offline.
+
+Serves POST /v1/embeddings with the local hashing embedder and enforces
+per-minute request and token limits the way a provider does: calls over
+budget get HTTP 429 with a Retry-After header. It can also fail a share of
+calls with 500s and stop accepting calls after a number of them (to test
+resuming a failed upload).
+
+    python stub_provider.py --port 8089 --rpm 120 --tpm 40000
+    RAG_OPENAI_BASE_URL=http://127.0.0.1:8089/v1 uvicorn main:app
+"""
+import sys
+import json
+import time
+import base64
+import random
+import argparse
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from local_models import HashingEmbeddings
+
+
+class StubState:
+    """Sliding one-minute windows of accepted requests and tokens."""
+
+    def __init__(self, rpm, tpm, error_rate, fail_after, latency):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.error_rate = error_rate
+        self.fail_after = fail_after
+        self.latency = latency
+        self.embeddings = HashingEmbeddings()
+        self.window = deque()   # (time, tokens) of accepted calls
+        self.counts = {"accepted": 0, "rate_limited": 0, "failed": 0, "inputs": 0}
+        self.lock = threading.Lock()
+
+    def admit(self, tokens):
+        """None if the call may run, else the seconds to wait before retrying."""
+        with self.lock:
+            now = time.monotonic()
+            while self.window and now - self.window[0][0] >= 60:
+                self.window.popleft()
+            used = sum(t for _, t in self.window)
+            if (self.rpm and len(self.window) >= self.rpm) or (self.tpm and used + tokens > self.tpm):
+                self.counts["rate_limited"] += 1
+                return 60 - (now - self.window[0][0]) if self.window else 1.0
+            self.window.append((now, tokens))
+            self.counts["accepted"] += 1
+            return None
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    state = None
+
+    def _send(self, status, body, headers=()):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/stats"):
+            self._send(200, self.state.counts)
+        else:
+            self._send(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        state = self.state
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if not self.path.rstrip("/").endswith("/embeddings"):
+            self._send(404, {"error": {"message": "not found"}})
+            return
+        texts = request.get("input", [])
+        texts = [texts] if isinstance(texts, str) else texts
+        tokens = sum(len(str(text).split()) for text in texts)
+
+        if state.fail_after is not None and state.counts["accepted"] >= state.fail_after:
+            state.counts["failed"] += 1
+            self._send(401, {"error": {"message": "Stub stopped accepting calls (--fail-after)", "type": "invalid_request_error"}})
+            return
+        wait = state.admit(tokens)
+        if wait is not None:
+            self._send(429, {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}},
+                       [("Retry-After", f"{max(wait, 0.1):.2f}")])
+            return
+        if random.random() < state.error_rate:
+            state.counts["failed"] += 1
+            self._send(500, {"error": {"message": "Simulated server error", "type": "server_error"}})
+            return
+        if state.latency:
+            time.sleep(state.latency)
+
+        vectors = state.embeddings._embed([str(text) for text in texts])
+        with state.lock:
+            state.counts["inputs"] += len(texts)
+        if request.get("encoding_format") == "base64":
+            data = [base64.b64encode(vector.tobytes()).decode("ascii") for vector in vectors]
+        else:
+            data = vectors.tolist()
+        self._send(200, {
+            "object": "list",
+            "model": request.get("model", "stub"),
+            "data": [{"object": "embedding", "index": i, "embedding": vector} for i, vector in enumerate(data)],
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        })
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port=8089, rpm=0, tpm=0, error_rate=0.0, fail_after=None, latency=0.0):
+    """Starts the stub in a background thread and returns the server (call .shutdown() to stop)."""
+    handler = type("Handler", (StubHandler,), {"state": StubState(rpm, tpm, error_rate, fail_after, latency)})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI-compatible embeddings stub with rate limits.")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--rpm", type=int, default=0, help="Requests per minute (0 = unlimited)")
+    parser.add_argument("--tpm", type=int, default=0, help="Tokens (words) per minute (0 = unlimited)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of calls failing with HTTP 500")
+    parser.add_argument("--fail-after", type=int, default=None, help="Answer 401 after this many accepted calls")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds per accepted call")
+    args = parser.parse_args()
+    server = serve(args.port, args.rpm, args.tpm, args.error_rate, args.fail_after, args.latency)
+    print(f"🧪 Embeddings stub on http://127.0.0.1:{args.port}/v1 (rpm={args.rpm}, tpm={args.tpm})")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+        sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
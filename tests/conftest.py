@@ -0,0 +1,21 @@
+import os
+import sys
+
+# The modules live at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import embed_scheduler
+import rag_engine
+
+
+@pytest.fixture
+def manager(tmp_path, monkeypatch):
+    """A RAGManager with its database, caches and uploads under tmp_path."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(rag_engine, "DB_PATH", str(tmp_path / "db"))
+    # Small batches, so an upload takes many provider calls
+    monkeypatch.setattr(embed_scheduler, "EMBED_BATCH_SIZE", 8)
+    monkeypatch.setattr(embed_scheduler, "EMBED_MAX_BATCH", 8)
+    return rag_engine.RAGManager(parse_workers=1)
@@ -0,0 +1,52 @@
+import threading
+import time
+
+import database
+
+
+def test_old_messages_are_archived_while_the_server_runs(tmp_path, monkeypatch):
+    # The chat and archive databases are relative paths
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(database, "_local", threading.local())
+    monkeypatch.setattr(database, "RETENTION_DAYS", 30)
+    monkeypatch.setattr(database, "_next_archive", 0.0)
+    database.init_db()
+
+    # A message that aged past the retention period after startup
+    with database._get_conn() as conn:
+        conn.execute(
+            "INSERT INTO chat_history (session_id, role, content, timestamp) "
+            "VALUES ('s', 'user', 'old', datetime('now', '-40 days'))"
+        )
+    # Next interval is due
+    monkeypatch.setattr(database, "_next_archive", 0.0)
+    database.add_messages("s", [("user", "new")])
+
+    for _ in range(50):
+        if [m["content"] for m in database.get_chat_history("s")] == ["new"]:
+            break
+        time.sleep(0.1)
+    assert [m["content"] for m in database.get_chat_history("s")] == ["new"]
+    # At most one run per interval
+    assert not database._claim_archive_run()
+
+
+def test_history_fetch_seeks_instead_of_scanning_the_session(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(database, "_local", threading.local())
+    database.init_db()
+    with database._get_conn() as conn:
+        conn.executemany(
+            "INSERT INTO chat_history (session_id, role, content) VALUES ('s', 'user', ?)",
+            [(str(i),) for i in range(20000)]
+        )
+
+    # The query get_chat_history actually runs, with its parameters inlined by the trace
+    statements = []
+    conn.set_trace_callback(statements.append)
+    history = database.get_chat_history("s", limit=50, after_id=19996)
+    conn.set_trace_callback(None)
+    plan = " ".join(row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {statements[-1]}"))
+    assert "idx_chat_session (session_id=? AND rowid>?)" in plan
+    assert "TEMP B-TREE" not in plan
+    assert [m["content"] for m in history] == ["19996", "19997", "19998", "19999"]
\ No newline at end of file
@@ -0,0 +1,76 @@
+import threading
+
+import pytest
+
+import embed_scheduler
+import rag_engine
+import stub_provider
+
+
+@pytest.fixture
+def upload(tmp_path):
+    path = tmp_path / "notes.txt"
+    path.write_text("\n\n".join(f"Paragraph {i} talks about topic{i} and topic{i + 1} in some detail." for i in range(2000)))
+    return [str(path)]
+
+
+def serve_stub(monkeypatch, port=0, **limits):
+    server = stub_provider.serve(port, **limits)
+    monkeypatch.setattr(rag_engine, "OPENAI_BASE_URL", f"http://127.0.0.1:{server.server_address[1]}/v1")
+    return server, server.RequestHandlerClass.state
+
+
+def test_long_ingestion_survives_client_pool_eviction(manager, upload, monkeypatch):
+    server, stub = serve_stub(monkeypatch, latency=0.2)
+    # Everything not leased is idle after 50 ms and only one client fits
+    manager.clients.idle_timeout = 0.05
+    manager.clients.max_clients = 1
+    done = threading.Event()
+
+    def ask():
+        while not done.is_set():
+            manager.get_answer("topic1", [], "alice", "local", "local")
+
+    asker = threading.Thread(target=ask)
+    asker.start()
+    try:
+        chunks = manager.process_files(upload, "alice", "public", "openai", "sk-test")
+    finally:
+        done.set()
+        asker.join()
+        server.shutdown()
+    assert chunks > 0
+    assert stub.counts["inputs"] == chunks
+    assert manager.clients.evicted > 0
+
+
+def test_rate_limited_upload_is_retried(manager, upload, monkeypatch):
+    monkeypatch.setattr(embed_scheduler, "RETRY_MAX_DELAY", 0.1)
+    server, stub = serve_stub(monkeypatch, error_rate=0.3)
+    try:
+        chunks = manager.process_files(upload, "alice", "public", "openai", "sk-test")
+    finally:
+        server.shutdown()
+    assert stub.counts["failed"] > 0
+    assert len(manager.vector_store) == chunks
+
+
+def test_failed_upload_resumes_from_checkpoint(manager, upload, monkeypatch):
+    server, stub = serve_stub(monkeypatch, fail_after=2)
+    with pytest.raises(Exception):
+        manager.process_files(upload, "alice", "public", "openai", "sk-test")
+    server.shutdown()
+    server.server_close()
+    checkpointed = stub.counts["inputs"]
+    assert checkpointed > 0
+
+    # Same address: the pooled ingestion client is reused
+    server, stub = serve_stub(monkeypatch, port=server.server_address[1])
+    progress = rag_engine.new_progress()
+    try:
+        chunks = manager.process_files(upload, "alice", "public", "openai", "sk-test", progress=progress)
+    finally:
+        server.shutdown()
+    assert progress["chunks_resumed"] == checkpointed
+    assert stub.counts["inputs"] == chunks - checkpointed
+    assert manager.embed_checkpoint.count(rag_engine.EMBEDDING_MODELS["openai"]) == 0
@@ -0,0 +1,16 @@
+import numpy as np
+
+from embedding_cache import EmbeddingCache
+
+
+def test_overwriting_a_key_does_not_count_as_a_new_row(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "cache.db"), max_memory_items=1, max_disk_items=10)
+    for n in range(9):
+        cache.put(f"k{n}", np.full(4, n))
+    for _ in range(20):
+        cache.put("k0", np.ones(4))
+    assert cache.stats()["disk_items"] == 9
+
+    # Nothing was evicted, and the overwrite took effect
+    assert all(cache.get(f"k{n}") is not None for n in range(9))
+    assert cache.get("k0").tolist() == [1, 1, 1, 1]
@@ -0,0 +1,42 @@
+import time
+
+import pytest
+
+import parsing
+from parsing import parse_files
+
+
+def slow_split(docs):
+    """Sleeps for as many seconds as the file says, then returns its docs."""
+    time.sleep(float(docs[0].page_content))
+    return docs
+
+
+@pytest.fixture
+def files(tmp_path):
+    paths = []
+    for name, seconds in (("stuck.txt", "30"), ("quick1.txt", "0"), ("quick2.txt", "0.2")):
+        path = tmp_path / name
+        path.write_text(seconds)
+        paths.append(str(path))
+    return paths
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_stuck_file_times_out_and_others_still_parse(files, workers):
+    # Started workers, so their startup doesn't count against the timeout
+    list(parse_files(files[1:2], workers=workers))
+    start = time.monotonic()
+    results = {path: error for path, _, error in parse_files(files, workers=workers, timeout=2, split=slow_split)}
+    assert time.monotonic() - start < 20
+    assert isinstance(results.pop(files[0]), TimeoutError)
+    assert list(results.values()) == [None, None]
+
+
+def test_pool_is_reused_across_calls(tmp_path):
+    path = tmp_path / "a.txt"
+    path.write_text("0")
+    list(parse_files([str(path)], workers=2))
+    pool = parsing.get_pool(2)
+    list(parse_files([str(path)], workers=2))
+    assert parsing.get_pool(2) is pool
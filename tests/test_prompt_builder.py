@@ -0,0 +1,12 @@
+from langchain_classic.schema import Document
+
+from chunking import split_documents
+from prompt_builder import build_context
+
+
+def test_full_size_chunks_are_not_trimmed():
+    text = " ".join(f"Sentence {i} mentions item{i} once." for i in range(400))
+    chunks = split_documents([Document(page_content=text, metadata={"source": "a.txt"})])
+    context = build_context([(doc, 0.0) for doc in chunks[:3]], "unrelated question", 5000)
+    for doc in chunks[:3]:
+        assert doc.page_content in context
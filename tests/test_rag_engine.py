@@ -0,0 +1,15 @@
+def test_cached_answers_stay_within_their_conversation(manager, tmp_path):
+    path = tmp_path / "notes.txt"
+    path.write_text("The launch is planned for March.\n\nThe budget was approved in May.")
+    manager.process_files([str(path)], "alice", "private", "local", "local")
+
+    question = "When is it planned?"
+    first = [{"role": "user", "content": "Tell me about the launch."}, {"role": "assistant", "content": "It is in March."}]
+    second = [{"role": "user", "content": "Tell me about the budget."}, {"role": "assistant", "content": "It was approved."}]
+
+    manager.get_answer(question, first, "alice", "local", "local")
+    manager.get_answer(question, second, "alice", "local", "local")
+    assert manager.answer_cache.hits == 0
+
+    manager.get_answer(question, first, "alice", "local", "local")
+    assert manager.answer_cache.hits == 1
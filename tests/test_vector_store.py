@@ -0,0 +1,163 @@
+import os
+
+import numpy as np
+import faiss
+import pytest
+from langchain_classic.schema import Document
+
+import vector_store
+from vector_store import Segment, SegmentedStore, build_index
+
+
+@pytest.fixture(scope="module")
+def ivf_segment():
+    """An IVF segment of 20k vectors where "alice" owns only 55."""
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((20000, 32)).astype(np.float32)
+    codes = np.full(len(vectors), 1, dtype=np.int32)
+    codes[rng.choice(len(vectors), 55, replace=False)] = 0
+    index = build_index(vectors, "ivf")
+    segment = Segment("s1", index, np.arange(len(vectors), dtype=np.int64), codes, ["alice", "bob"], vectors=vectors)
+    return segment, vectors, codes
+
+
+def exact_hits(vectors, codes, queries, k):
+    visible = np.flatnonzero(codes == 0)
+    _, hits = faiss.knn(queries, vectors[visible], k)
+    return visible[hits]
+
+
+def test_selective_filter_returns_k_hits(ivf_segment):
+    segment, vectors, codes = ivf_segment
+    queries = np.random.default_rng(1).standard_normal((20, 32)).astype(np.float32)
+    _, positions = segment.search(queries, "alice", 10, nprobe=1)
+    assert (positions >= 0).all()
+    assert (positions == exact_hits(vectors, codes, queries, 10)).all()
+
+
+def test_filter_smaller_than_k_is_padded(ivf_segment):
+    segment, _, _ = ivf_segment
+    queries = np.zeros((2, 32), dtype=np.float32)
+    distances, positions = segment.search(queries, "alice", 60)
+    assert (positions[:, :55] >= 0).all() and (positions[:, 55:] == -1).all()
+    assert distances.shape == (2, 60)
+
+
+def test_large_filter_scales_nprobe(ivf_segment, monkeypatch):
+    segment, vectors, codes = ivf_segment
+    monkeypatch.setattr(vector_store, "EXACT_SEARCH_MAX_BYTES", 0)
+    segment = segment.with_tombstones(set())
+    queries = np.random.default_rng(2).standard_normal((20, 32)).astype(np.float32)
+    _, positions = segment.search(queries, "alice", 10, nprobe=1)
+    assert (positions >= 0).all()
+
+
+def make_docs(n, owner="alice"):
+    return [
+        Document(page_content=f"chunk {i}", metadata={"source": "a.txt", "owner": owner, "privacy": "private"})
+        for i in range(n)
+    ]
+
+
+def test_ingestion_is_flushed_in_parts_and_published_together(tmp_path):
+    store = SegmentedStore.load(str(tmp_path / "db"))
+    builder = store.new_builder()
+    builder.flush_every = 4
+    vectors = np.random.default_rng(3).standard_normal((10, 8)).astype(np.float32)
+    refs = [("alice/a.txt", f"h{i}") for i in range(10)]
+    for start in range(0, 10, 2):
+        builder.add(refs[start:start + 2], vectors[start:start + 2], make_docs(10)[start:start + 2])
+    # Only the chunks since the last flush are held in memory
+    assert len(builder.docs) == 2 and len(builder) == 10
+
+    sources = {"alice/a.txt": {"file_hash": "x", "privacy": "private", "chunks": {}}}
+    store.commit(builder, sources)
+    builder.discard()
+    assert [len(seg.ids) for seg in store.segments] == [4, 4, 2]
+    assert store.version == 1
+    assert sorted(store.sources["alice/a.txt"]["chunks"].values()) == list(range(10))
+
+    reloaded = SegmentedStore.load(str(tmp_path / "db"))
+    ids, _ = reloaded.search_ids(vectors[7:8], "alice", k=1)
+    assert ids.tolist() == [7]
+    assert reloaded.chunks.get([7])[7].page_content == "chunk 7"
+    assert not os.listdir(tmp_path / "db" / "builds")
+
+
+def test_legacy_folder_without_sources_json_is_migrated_per_file(tmp_path):
+    from langchain_community.vectorstores import FAISS
+    from local_models import HashingEmbeddings
+
+    docs = make_docs(3) + make_docs(3)   # the same file uploaded twice
+    docs.append(Document(page_content="shared", metadata={"source": "b.txt", "owner": "bob", "privacy": "public"}))
+    FAISS.from_documents(docs, HashingEmbeddings()).save_local(str(tmp_path / "db"))
+
+    store = SegmentedStore.load(str(tmp_path / "db"))
+    assert sorted(store.sources) == ["alice/a.txt", "bob/b.txt"]
+    assert sorted(store.sources["alice/a.txt"]["chunks"].values()) == [3, 4, 5]
+    assert store.sources["bob/b.txt"]["privacy"] == "public"
+    assert len(store) == 4
+
+    assert store.delete_sources(["alice/a.txt"]) == {"alice/a.txt": 3}
+    assert len(store) == 1
+
+
+def commit_file(store, file_name, n, seed):
+    builder = store.new_builder()
+    vectors = np.random.default_rng(seed).standard_normal((n, 8)).astype(np.float32)
+    docs = [Document(page_content=f"{file_name} {i}", metadata={"source": file_name, "owner": "alice", "privacy": "private"}) for i in range(n)]
+    builder.add([(f"alice/{file_name}", f"h{i}") for i in range(n)], vectors, docs)
+    store.commit(builder, {f"alice/{file_name}": {"file_hash": file_name, "privacy": "private", "chunks": {}}})
+    builder.discard()
+
+
+def test_purged_tombstones_stay_purged_after_restart(tmp_path, monkeypatch):
+    # No background compaction: the test runs the one it needs
+    monkeypatch.setattr(vector_store, "COMPACT_DEAD_RATIO", 2.0)
+    path = str(tmp_path / "db")
+    store = SegmentedStore.load(path, max_segments=100)
+    commit_file(store, "a.txt", 5, 0)
+    commit_file(store, "b.txt", 5, 1)
+    store.delete_sources(["alice/a.txt"])
+    assert len(store.tombstones) == 5
+
+    # Rewrites the first segment without its dead vectors; the delete marker segment still lists them
+    store.compact(victims=[store.segments[0]])
+    assert not store.tombstones
+    assert not SegmentedStore.load(path, max_segments=100).tombstones
+
+
+def test_selector_cache_is_shared_and_bounded(ivf_segment, monkeypatch):
+    monkeypatch.setattr(vector_store, "SELECTOR_CACHE_SIZE", 2)
+    segment = ivf_segment[0].with_tombstones(set())
+    queries = np.zeros((1, 32), dtype=np.float32)
+    for n in range(50):
+        segment.search(queries, f"visitor{n}", 4)
+    # Users without documents here all see the public vectors only
+    assert list(segment._selectors) == [(None, vector_store.NPROBE, vector_store.EF_SEARCH)]
+
+    segment.search(queries, "alice", 4)
+    segment.search(queries, "bob", 4)
+    assert [key[0] for key in segment._selectors] == ["alice", "bob"]
+
+
+def test_exact_search_gathers_visible_vectors_once(ivf_segment, monkeypatch):
+    segment = ivf_segment[0].with_tombstones(set())
+    gathered = []
+    get_vectors = segment.get_vectors
+    monkeypatch.setattr(segment, "get_vectors", lambda positions: gathered.append(len(positions)) or get_vectors(positions))
+    queries = np.zeros((1, 32), dtype=np.float32)
+    for _ in range(3):
+        segment.search(queries, "alice", 4)
+    assert gathered == [55]
+
+
+def test_selector_cache_is_bounded_by_bytes(ivf_segment, monkeypatch):
+    # Room for the vectors of one small filter only
+    monkeypatch.setattr(vector_store, "SELECTOR_CACHE_BYTES", 55 * 32 * 4)
+    segment = ivf_segment[0].with_tombstones(set())
+    queries = np.zeros((1, 32), dtype=np.float32)
+    segment.search(queries, "alice", 4, nprobe=1)
+    segment.search(queries, "alice", 4, nprobe=2)
+    assert [key[1] for key in segment._selectors] == [2]
+    assert segment._selector_bytes == 55 * 32 * 4
@@ -0,0 +1,1136 @@
+import os
+import copy
+import json
+import time
+import hashlib
+import pickle
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+import faiss
+
+try:
+    import fcntl
+except ImportError:   # Windows: store changes are only serialised within one process
+    fcntl = None
+
+from chunk_store import ChunkStore, CHUNKS_FILE
+
+# Files inside the database folder
+MANIFEST_FILE = "manifest.json"
+SEGMENTS_DIR = "segments"
+# Lock file serialising writers across processes (e.g. uvicorn workers)
+LOCK_FILE = "write.lock"
+# Scratch folders of ingestions in progress (see SegmentBuilder)
+BUILDS_DIR = "builds"
+# Scratch folders untouched for this long belong to a crashed ingestion
+BUILD_STALE_SECONDS = 24 * 3600
+# Single-file format written by LangChain's FAISS.save_local (migrated on first load)
+LEGACY_FILES = ("index.faiss", "index.pkl", "sources.json")
+
+# An ingestion writes its chunks to disk every this many, so its memory stays flat
+INGEST_FLUSH_CHUNKS = int(os.getenv("RAG_INGEST_FLUSH_CHUNKS", 10000))
+
+# Background compaction keeps the number of segments at or below this
+COMPACT_MAX_SEGMENTS = int(os.getenv("RAG_COMPACT_MAX_SEGMENTS", 8))
+# A segment whose share of deleted vectors reaches this is rewritten on its own
+COMPACT_DEAD_RATIO = float(os.getenv("RAG_COMPACT_DEAD_RATIO", 0.3))
+
+# Index built for compacted segments: "flat", "ivf", "hnsw", "ivfpq" or "auto" (= ivf)
+INDEX_TYPE = os.getenv("RAG_INDEX_TYPE", "auto")
+# Segments smaller than this always use an exact flat index
+ANN_THRESHOLD = int(os.getenv("RAG_ANN_THRESHOLD", 50000))
+# Search-time knobs: IVF lists probed / HNSW candidate list size
+NPROBE = int(os.getenv("RAG_NPROBE", 16))
+EF_SEARCH = int(os.getenv("RAG_EF_SEARCH", 64))
+# Approximate segments where the vectors a user sees take at most this many bytes
+# are searched exactly over those; above it, nprobe / efSearch grow with 1 / selectivity
+EXACT_SEARCH_MAX_BYTES = int(os.getenv("RAG_EXACT_SEARCH_MAX_BYTES", 16 * 2 ** 20))
+# Access filters cached per segment; the least recently used go first
+SELECTOR_CACHE_SIZE = int(os.getenv("RAG_SELECTOR_CACHE_SIZE", 64))
+# Bytes of gathered vectors (for exact searches) the filter cache of one segment may hold
+SELECTOR_CACHE_BYTES = int(os.getenv("RAG_SELECTOR_CACHE_BYTES", 64 * 2 ** 20))
+HNSW_M = 32
+# Vectors sampled to train IVF centroids / PQ codebooks
+MAX_TRAIN_VECTORS = 100000
+
+# Memory-map segment indexes read-only instead of reading them into RAM
+MMAP_INDEX = os.getenv("RAG_MMAP_INDEX", "1") == "1"
+# Zero-copy mmap where this FAISS build supports it
+MMAP_FLAGS = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+
+
+def _fsync_dir(path):
+    if hasattr(os, "O_DIRECTORY"):
+        fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def _write_json(path, data):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def resolve_index_type(n, index_type=None, threshold=None):
+    """Maps the configured index type to the one used for a segment of n vectors."""
+    index_type = index_type or INDEX_TYPE
+    threshold = ANN_THRESHOLD if threshold is None else threshold
+    if n < threshold or index_type == "flat":
+        return "flat"
+    return "ivf" if index_type == "auto" else index_type
+
+
+def get_index_type(index):
+    if index is None or isinstance(index, faiss.IndexFlat):
+        return "flat"
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(index, faiss.IndexIVFPQ):
+        return "ivfpq"
+    if isinstance(index, faiss.IndexIVF):
+        return "ivf"
+    return "flat"
+
+
+def build_index(vectors, index_type):
+    """Builds (and trains, if needed) a FAISS index of `index_type` over `vectors`."""
+    n, d = vectors.shape
+    # IVF needs ~39 training points per list, PQ needs 256 per codebook
+    nlist = min(max(int(4 * np.sqrt(n)), 16), n // 39)
+    if index_type == "ivfpq" and n < 256 * 39:
+        index_type = "ivf"
+    if index_type in ("ivf", "ivfpq") and nlist < 2:
+        index_type = "flat"
+
+    if index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(d, HNSW_M)
+        index.hnsw.efConstruction = 2 * HNSW_M
+    elif index_type in ("ivf", "ivfpq"):
+        quantizer = faiss.IndexFlatL2(d)
+        if index_type == "ivf":
+            index = faiss.IndexIVFFlat(quantizer, d, nlist)
+        else:
+            # Largest number of sub-quantizers (<= 64) that divides the dimension
+            m = max(x for x in range(1, min(64, d) + 1) if d % x == 0)
+            index = faiss.IndexIVFPQ(quantizer, d, nlist, m, 8)
+        if n > MAX_TRAIN_VECTORS:
+            sample = vectors[np.random.default_rng(0).choice(n, MAX_TRAIN_VECTORS, replace=False)]
+        else:
+            sample = vectors
+        index.train(np.ascontiguousarray(sample))
+    else:
+        index = faiss.IndexFlatL2(d)
+
+    index.add(np.ascontiguousarray(vectors))
+    return index
+
+
+def chunk_id(owner, file_name, content):
+    """Hash naming a chunk within its file's manifest entry."""
+    raw = f"{owner}\x00{file_name}\x00{content}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def owner_codes(docs):
+    """
+    Encodes the visibility of each position: -1 for public chunks, otherwise
+    the index of the chunk's owner in the returned owner list.
+    """
+    owners = {}
+    codes = np.empty(len(docs), dtype=np.int32)
+    for position, doc in enumerate(docs):
+        if doc.metadata.get("privacy", "private") == "public":
+            codes[position] = -1
+        else:
+            codes[position] = owners.setdefault(doc.metadata.get("owner", "unknown"), len(owners))
+    return codes, list(owners)
+
+
+class SegmentBuilder:
+    """
+    Collects the vectors of one ingestion before they are written as segments.
+    With a `spill_dir`, every `flush_every` chunks the pending vectors and
+    Documents are written there as one part, so only the refs stay in memory
+    however large the upload; commit() turns every part into a segment.
+    """
+
+    def __init__(self, spill_dir=None, flush_every=INGEST_FLUSH_CHUNKS):
+        self.spill_dir = spill_dir
+        self.flush_every = flush_every
+        self.refs = []   # (source key, chunk hash) per position, across all parts
+        self.index = None
+        self.docs = []
+        self._parts = []   # (folder, chunk count) of the flushed parts
+
+    def __len__(self):
+        return len(self.refs)
+
+    def add(self, refs, vectors, docs):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.index is None:
+            self.index = faiss.IndexFlatL2(vectors.shape[1])
+        self.index.add(vectors)
+        self.refs.extend(refs)
+        self.docs.extend(docs)
+        if self.spill_dir is not None and len(self.docs) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        """Writes the pending chunks to `spill_dir` as one part."""
+        if not self.docs:
+            return
+        part_dir = os.path.join(self.spill_dir, f"part_{len(self._parts):06d}")
+        os.makedirs(part_dir)
+        faiss.write_index(self.index, os.path.join(part_dir, "index.faiss"))
+        with open(os.path.join(part_dir, "docs.pkl"), "wb") as f:
+            pickle.dump(self.docs, f, protocol=pickle.HIGHEST_PROTOCOL)
+        self._parts.append((part_dir, len(self.docs)))
+        self.index, self.docs = None, []
+
+    def parts(self):
+        """Yields (index, docs) of every part in order, reading flushed ones back one at a time."""
+        for part_dir, _ in self._parts:
+            index = faiss.read_index(os.path.join(part_dir, "index.faiss"))
+            with open(os.path.join(part_dir, "docs.pkl"), "rb") as f:
+                docs = pickle.load(f)
+            yield index, docs
+        if self.docs or not self._parts:
+            yield self.index, self.docs
+
+    @property
+    def part_count(self):
+        return len(self._parts) + (1 if self.docs or not self._parts else 0)
+
+    def discard(self):
+        """Removes the flushed parts (after commit, or when the ingestion failed)."""
+        if self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+        self._parts = []
+
+
+class Segment:
+    """
+    One immutable slice of the index.
+    Position i of `index` holds the vector with global id ids[i]. `sources` are
+    the manifest entries written by the ingestion that created the segment and
+    `tombstones` the vector ids (in older segments) it deleted.
+
+    Chunk texts live in the store's ChunkStore; a segment only keeps the
+    owner code of each position for access filtering. Segments are built in
+    memory, then written and re-opened from disk, where the index and arrays
+    are memory-mapped, so resident memory follows the working set.
+    """
+
+    def __init__(self, name, index, ids, codes=None, owners=None, sources=None, tombstones=None, vectors=None, seg_dir=None):
+        self.name = name
+        self.index = index
+        self.ids = ids if ids is not None else np.empty(0, dtype=np.int64)
+        # Raw vectors, kept for approximate indexes (flat indexes store them exactly)
+        self.vectors = vectors
+        self.tombstones = set(tombstones or ())
+        self.seg_dir = seg_dir
+
+        # Position -> owner code (see owner_codes), -1 for public chunks
+        self._codes = codes if codes is not None else np.empty(0, dtype=np.int32)
+        self._owners = owners or []
+        # Loaded segments read their sources on demand
+        self._sources = sources
+
+        self._tombstone_ref = set()
+        self._dead = None
+        self._selectors = OrderedDict()
+        self._selector_bytes = 0
+        self._selectors_lock = threading.Lock()
+
+    # --- LAZY ATTRIBUTES ---
+    @property
+    def sources(self):
+        if self._sources is None:
+            with open(os.path.join(self.seg_dir, "sources.json"), "r", encoding="utf-8") as f:
+                self._sources = json.load(f)
+        return self._sources
+
+    def set_dead(self, tombstones):
+        """Points the segment at the store's tombstone set; the mask is built on first use."""
+        self._tombstone_ref = tombstones
+        self._dead = None
+        self._selectors = OrderedDict()
+        self._selector_bytes = 0
+        self._selectors_lock = threading.Lock()
+
+    def with_tombstones(self, tombstones):
+        """
+        Copy sharing the index and arrays whose dead mask follows `tombstones`.
+        Used instead of set_dead() on published segments, which readers may be searching.
+        """
+        seg = copy.copy(self)
+        seg.set_dead(tombstones)
+        return seg
+
+    @property
+    def dead(self):
+        if self._dead is None:
+            tombstones = self._tombstone_ref
+            if tombstones and len(self.ids):
+                self._dead = np.isin(self.ids, np.fromiter(tombstones, dtype=np.int64, count=len(tombstones)))
+            else:
+                self._dead = np.zeros(len(self.ids), dtype=bool)
+        return self._dead
+
+    @property
+    def live(self):
+        if not self._tombstone_ref:
+            return len(self.ids)
+        return len(self.ids) - int(self.dead.sum())
+
+    @property
+    def index_type(self):
+        return get_index_type(self.index)
+
+    def get_vectors(self, positions):
+        positions = np.asarray(positions, dtype=np.int64)
+        if self.vectors is not None:
+            return np.asarray(self.vectors[positions], dtype=np.float32)
+        return self.index.reconstruct_batch(positions)
+
+    # --- SEARCH ---
+    def _make_params(self, selector, nprobe, ef_search):
+        if self.index_type in ("ivf", "ivfpq"):
+            return faiss.SearchParametersIVF(sel=selector, nprobe=nprobe)
+        if self.index_type == "hnsw":
+            return faiss.SearchParametersHNSW(sel=selector, efSearch=ef_search)
+        return faiss.SearchParameters(sel=selector) if selector is not None else None
+
+    def _visibility(self, username, nprobe, ef_search):
+        """
+        (search_params, keepalive, visible_count, exact) for `username`:
+        FAISS params restricting the search to the live vectors the user may
+        see (their own documents plus public ones), or, for an approximate
+        index where few are visible, exact = (positions, vectors) of those to
+        search exactly instead. A fixed nprobe / efSearch only visits a share
+        of the index, so a selective filter would otherwise leave fewer than
+        k hits. The vectors are gathered once and cached with the entry.
+        `keepalive` holds the bitmap and selector the params point at; the
+        caller keeps it until the search is done.
+        Users without documents in this segment share the public-only entry.
+        """
+        owner = username if username in self._owners else None
+        cache_key = (owner, nprobe, ef_search)
+        with self._selectors_lock:
+            entry = self._selectors.get(cache_key)
+            if entry is not None:
+                self._selectors.move_to_end(cache_key)
+                return entry
+
+        n = len(self.ids)
+        mask = self._codes == -1
+        if owner is not None:
+            mask |= self._codes == self._owners.index(owner)
+        mask &= ~self.dead
+        visible = int(mask.sum())
+
+        exact = None
+        if visible == n:
+            bitmap, selector = None, None
+        else:
+            bitmap = np.packbits(mask, bitorder="little")
+            selector = faiss.IDSelectorBitmap(n, faiss.swig_ptr(bitmap))
+            if self.index_type != "flat":
+                if visible * self.index.d * 4 <= EXACT_SEARCH_MAX_BYTES:
+                    positions = np.flatnonzero(mask)
+                    exact = (positions, np.ascontiguousarray(self.get_vectors(positions)))
+                else:
+                    scale = n / visible
+                    nprobe = min(int(np.ceil(nprobe * scale)), getattr(self.index, "nlist", nprobe))
+                    ef_search = int(np.ceil(ef_search * scale))
+        entry = (self._make_params(selector, nprobe, ef_search), (bitmap, selector), visible, exact)
+        with self._selectors_lock:
+            previous = self._selectors.pop(cache_key, None)
+            self._selector_bytes += self._entry_bytes(entry) - self._entry_bytes(previous)
+            self._selectors[cache_key] = entry
+            while len(self._selectors) > 1 and (
+                len(self._selectors) > SELECTOR_CACHE_SIZE or self._selector_bytes > SELECTOR_CACHE_BYTES
+            ):
+                _, dropped = self._selectors.popitem(last=False)
+                self._selector_bytes -= self._entry_bytes(dropped)
+        return entry
+
+    @staticmethod
+    def _entry_bytes(entry):
+        return entry[3][1].nbytes if entry is not None and entry[3] is not None else 0
+
+    def search(self, query_matrix, username, k, nprobe=NPROBE, ef_search=EF_SEARCH):
+        """
+        (distances, positions) of the best k vectors `username` may see for
+        every query row, -1 padded, or None when the user sees none here.
+        """
+        # `keepalive` stays referenced until the search returns, even if the cache drops the entry
+        params, keepalive, visible, exact = self._visibility(username, nprobe, ef_search)
+        if visible == 0:
+            return None
+        if exact is None:
+            return self.index.search(query_matrix, k, params=params)
+
+        exact_positions, exact_vectors = exact
+        found = min(k, visible)
+        distances, hits = faiss.knn(query_matrix, exact_vectors, found)
+        positions = np.where(hits >= 0, exact_positions[hits], -1)
+        if found < k:
+            pad = ((0, 0), (0, k - found))
+            distances = np.pad(distances, pad, constant_values=np.finfo(np.float32).max)
+            positions = np.pad(positions, pad, constant_values=-1)
+        return distances, positions
+
+    # --- PERSISTENCE ---
+    def save(self, seg_dir):
+        os.makedirs(seg_dir)
+        if self.index is not None:
+            faiss.write_index(self.index, os.path.join(seg_dir, "index.faiss"))
+        np.save(os.path.join(seg_dir, "ids.npy"), np.asarray(self.ids, dtype=np.int64))
+        if self.vectors is not None:
+            np.save(os.path.join(seg_dir, "vectors.npy"), np.asarray(self.vectors, dtype=np.float32))
+
+        np.save(os.path.join(seg_dir, "owners.npy"), np.asarray(self._codes, dtype=np.int32))
+
+        _write_json(os.path.join(seg_dir, "sources.json"), self._sources or {})
+        _write_json(os.path.join(seg_dir, "meta.json"), {
+            "tombstones": sorted(self.tombstones),
+            "owners": self._owners,
+        })
+
+    @classmethod
+    def load(cls, seg_dir, name, mmap_index=MMAP_INDEX):
+        index_path = os.path.join(seg_dir, "index.faiss")
+        index = None
+        if os.path.exists(index_path):
+            index = faiss.read_index(index_path, MMAP_FLAGS if mmap_index else 0)
+        ids = np.load(os.path.join(seg_dir, "ids.npy"), mmap_mode="r")
+        vectors_path = os.path.join(seg_dir, "vectors.npy")
+        vectors = np.load(vectors_path, mmap_mode="r") if os.path.exists(vectors_path) else None
+        with open(os.path.join(seg_dir, "meta.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        codes = np.load(os.path.join(seg_dir, "owners.npy"), mmap_mode="r")
+        return cls(name, index, ids, codes, meta["owners"], tombstones=meta["tombstones"], vectors=vectors, seg_dir=seg_dir)
+
+
+def prune_tombstones(tombstones, segments):
+    """The tombstones that still point at a vector in one of `segments`."""
+    if not tombstones:
+        return set()
+    wanted = np.fromiter(tombstones, dtype=np.int64, count=len(tombstones))
+    found = np.zeros(len(wanted), dtype=bool)
+    for seg in segments:
+        found |= np.isin(wanted, seg.ids)
+    return set(wanted[found].tolist())
+
+
+def merge_segments(name, segments, tombstones, index_type=None, threshold=None):
+    """
+    Builds one segment out of `segments`, physically dropping tombstoned
+    vectors. The merged index type follows resolve_index_type().
+    """
+    ids, codes, vectors = [], [], []
+    owners = {}
+    merged_tombstones = set()
+    sources = {}
+    dead_ids = np.fromiter(tombstones, dtype=np.int64, count=len(tombstones))
+    for seg in segments:
+        merged_tombstones |= seg.tombstones
+        for key, entry in seg.sources.items():
+            if key not in sources or entry["version"] > sources[key]["version"]:
+                sources[key] = entry
+        if seg.index is None or not len(seg.ids):
+            continue
+
+        keep = np.flatnonzero(~np.isin(seg.ids, dead_ids))
+        if not len(keep):
+            continue
+        vectors.append(seg.get_vectors(keep))
+        ids.append(np.asarray(seg.ids)[keep])
+        # Re-number owner codes into the merged segment's owner list
+        remap = np.array([owners.setdefault(owner, len(owners)) for owner in seg._owners] + [-1], dtype=np.int32)
+        codes.append(remap[np.asarray(seg._codes)[keep]])
+
+    index, raw_vectors = None, None
+    ids = np.concatenate(ids) if ids else np.empty(0, dtype=np.int64)
+    codes = np.concatenate(codes) if codes else np.empty(0, dtype=np.int32)
+    if vectors:
+        vectors = np.concatenate(vectors)
+        index = build_index(vectors, resolve_index_type(len(vectors), index_type, threshold))
+        if get_index_type(index) != "flat":
+            raw_vectors = vectors
+
+    # Tombstones for vectors that lived in these segments are now fully applied
+    all_ids = np.concatenate([seg.ids for seg in segments]) if segments else np.empty(0, dtype=np.int64)
+    merged_tombstones -= set(all_ids.tolist())
+    return Segment(name, index, ids, codes, list(owners), sources, merged_tombstones, raw_vectors)
+
+
+class Snapshot:
+    """
+    Consistent, immutable view of the store at one version: the segment list,
+    the tombstones applied to it and (lazily) the merged source entries.
+    Readers take one with store.snapshot() and search it without any lock;
+    writers never modify a published snapshot, they swap in a new one.
+    """
+
+    def __init__(self, version, segments=(), tombstones=frozenset(), sources=None, next_vector_id=0):
+        self.version = version
+        self.segments = tuple(segments)
+        # Chunk rows at or above this id belong to a later version
+        self.next_vector_id = next_vector_id
+        self.tombstones = frozenset(tombstones)
+        self._sources = sources
+
+    def __len__(self):
+        """Number of live (searchable) vectors."""
+        return sum(seg.live for seg in self.segments)
+
+    @property
+    def sources(self):
+        """
+        Manifest entry of every ingested file, newest version wins; files
+        whose newest entry is a deletion marker are left out.
+        Built on first use, so loading the store (and searching it) never
+        reads the per-segment source lists.
+        """
+        if self._sources is None:
+            sources = {}
+            for seg in self.segments:
+                for key, entry in seg.sources.items():
+                    if key not in sources or entry["version"] > sources[key]["version"]:
+                        sources[key] = entry
+            self._sources = {key: entry for key, entry in sources.items() if not entry.get("deleted")}
+        return self._sources
+
+
+class SegmentedStore:
+    """
+    Append-only FAISS store made of immutable on-disk segments.
+
+    Every ingestion is written as one new segment folder and published by
+    atomically replacing a small manifest, so a save costs O(new data) and a
+    crash mid-save leaves the previous manifest (and store) intact. Deleted or
+    replaced chunks are tombstoned and filtered at search time until a
+    background compaction merges small segments and drops them for good.
+
+    In memory the searchable state is one Snapshot. Searches run lock-free
+    against the snapshot they started with; commit() and compaction build the
+    next one under a write lock and publish it with a single reference swap.
+
+    Several processes can share one store folder: segments are memory-mapped
+    read-only (one copy in the page cache however many processes map them),
+    writers take a file lock, and refresh() picks up other processes' commits
+    when the manifest on disk changes.
+    """
+
+    def __init__(self, path, max_segments=COMPACT_MAX_SEGMENTS, index_type=None, nprobe=NPROBE, ef_search=EF_SEARCH):
+        self.path = path
+        self.max_segments = max_segments
+        # None -> INDEX_TYPE
+        self.index_type = index_type
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        self.manifest = {"version": 0, "next_segment": 1, "next_vector_id": 0, "segments": []}
+        self._snapshot = Snapshot(0, sources={})
+        self._chunks = None
+        self._write_lock = threading.RLock()
+        self._lock_fd = None
+        self._lock_depth = 0
+        # (inode, mtime, size) of the manifest this store last read or wrote
+        self._marker = None
+        self._compacting = False
+
+    def __len__(self):
+        """Number of live (searchable) vectors."""
+        return len(self._snapshot)
+
+    def snapshot(self):
+        """The current Snapshot; stays valid (and unchanged) however the store moves on."""
+        return self._snapshot
+
+    def _snap(self, snapshot):
+        return self._snapshot if snapshot is None else snapshot
+
+    # Shortcuts to the current snapshot
+    @property
+    def version(self):
+        return self._snapshot.version
+
+    @property
+    def segments(self):
+        return self._snapshot.segments
+
+    @property
+    def tombstones(self):
+        return self._snapshot.tombstones
+
+    @property
+    def sources(self):
+        return self._snapshot.sources
+
+    @property
+    def chunks(self):
+        """ChunkStore holding the text and metadata of every vector id."""
+        if self._chunks is None:
+            os.makedirs(self.path, exist_ok=True)
+            self._chunks = ChunkStore(os.path.join(self.path, CHUNKS_FILE))
+        return self._chunks
+
+    # --- LOCKING ---
+    @contextmanager
+    def _locked(self, exclusive=True):
+        """
+        Serialises changes to the store across threads (RLock) and processes
+        (flock on LOCK_FILE). Refreshing from disk takes it shared, so a
+        writer never removes segment folders another process is opening.
+        Re-entrant within a thread; the outermost call decides the lock mode.
+        """
+        with self._write_lock:
+            outer = self._lock_depth == 0
+            if outer and fcntl is not None:
+                if self._lock_fd is None:
+                    os.makedirs(self.path, exist_ok=True)
+                    self._lock_fd = os.open(os.path.join(self.path, LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+                fcntl.flock(self._lock_fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+                if outer and fcntl is not None:
+                    fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    # --- LOADING ---
+    @classmethod
+    def load(cls, path, **kwargs):
+        store = cls(path, **kwargs)
+        manifest_path = os.path.join(path, MANIFEST_FILE)
+        if os.path.exists(manifest_path):
+            # Exclusive: the cleanup below would otherwise race another process's commit
+            with store._locked():
+                store.manifest = store._read_manifest()
+                store.chunks.delete_from(store.manifest["next_vector_id"])
+                segments = [Segment.load(store._segment_dir(name), name) for name in store.manifest["segments"]]
+                store._set_segments(segments)
+                store._remove_orphans()
+                store._remove_stale_builds()
+                store._remove_legacy_files()
+        elif os.path.exists(os.path.join(path, LEGACY_FILES[0])):
+            with store._locked():
+                store._migrate_legacy()
+        return store
+
+    def _manifest_marker(self):
+        """Cheap on-disk version marker: every publish replaces the manifest file (new inode)."""
+        try:
+            st = os.stat(os.path.join(self.path, MANIFEST_FILE))
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def _read_manifest(self):
+        self._marker = self._manifest_marker()
+        with open(os.path.join(self.path, MANIFEST_FILE), "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def refresh(self):
+        """
+        Picks up what other processes (uvicorn workers, another app) have
+        published since this store last looked. Costs one stat() when nothing
+        changed; otherwise only segments not already open are mapped.
+        Returns True if a newer snapshot was published.
+        """
+        marker = self._manifest_marker()
+        if marker is None or marker == self._marker:
+            return False
+        with self._locked(exclusive=False):
+            if self._manifest_marker() == self._marker:
+                return False
+            manifest = self._read_manifest()
+            if manifest["segments"] == [seg.name for seg in self.segments]:
+                self.manifest = manifest
+                return False
+            opened = {seg.name: seg for seg in self.segments}
+            segments = [
+                opened.get(name) or Segment.load(self._segment_dir(name), name)
+                for name in manifest["segments"]
+            ]
+            self.manifest = manifest
+            self._set_segments(segments)
+        print(f"🔄 Index refreshed to version {self.version}.")
+        return True
+
+    def ingest_snapshot(self):
+        """Up-to-date snapshot with its source entries read, for ingestion to diff uploads against."""
+        with self._locked(exclusive=False):
+            self.refresh()
+            snapshot = self._snapshot
+            snapshot.sources
+        return snapshot
+
+    def _segment_dir(self, name):
+        return os.path.join(self.path, SEGMENTS_DIR, name)
+
+    def _set_segments(self, segments):
+        """Publishes `segments` (as the manifest lists them) as the current snapshot."""
+        tombstones = set()
+        for seg in segments:
+            tombstones |= seg.tombstones
+        # Older segments' meta.json still lists ids a compaction has since purged
+        tombstones = frozenset(prune_tombstones(tombstones, segments))
+        # Copies: some of the segments may be part of a published snapshot
+        segments = [seg.with_tombstones(tombstones) for seg in segments]
+        self._snapshot = Snapshot(self.manifest["version"], segments, tombstones, next_vector_id=self.manifest["next_vector_id"])
+
+    def _remove_orphans(self):
+        # Segment folders not in the manifest come from a crashed save or compaction
+        segments_root = os.path.join(self.path, SEGMENTS_DIR)
+        if not os.path.isdir(segments_root):
+            return
+        for name in os.listdir(segments_root):
+            if name not in self.manifest["segments"]:
+                shutil.rmtree(os.path.join(segments_root, name), ignore_errors=True)
+
+    def _remove_stale_builds(self):
+        builds_root = os.path.join(self.path, BUILDS_DIR)
+        if not os.path.isdir(builds_root):
+            return
+        for name in os.listdir(builds_root):
+            build_dir = os.path.join(builds_root, name)
+            if time.time() - os.path.getmtime(build_dir) > BUILD_STALE_SECONDS:
+                shutil.rmtree(build_dir, ignore_errors=True)
+
+    def _remove_legacy_files(self):
+        for file_name in LEGACY_FILES:
+            legacy_path = os.path.join(self.path, file_name)
+            if os.path.exists(legacy_path):
+                os.remove(legacy_path)
+
+    def _migrate_legacy(self):
+        """Converts a LangChain save_local folder into the first segment."""
+        index = faiss.read_index(os.path.join(self.path, "index.faiss"))
+        with open(os.path.join(self.path, "index.pkl"), "rb") as f:
+            docstore, index_to_docstore_id = pickle.load(f)
+
+        ids = np.arange(index.ntotal, dtype=np.int64)
+        docs = []
+        vector_ids = {}
+        for position in range(index.ntotal):
+            doc_id = index_to_docstore_id[position]
+            docs.append(docstore.search(doc_id))
+            vector_ids[doc_id] = position
+
+        sources = {}
+        tombstones = []
+        sources_path = os.path.join(self.path, "sources.json")
+        if os.path.exists(sources_path):
+            with open(sources_path, "r", encoding="utf-8") as f:
+                for key, entry in json.load(f).items():
+                    chunks = {h: vector_ids[h] for h in entry["chunks"] if h in vector_ids}
+                    sources[key] = {"file_hash": entry["file_hash"], "privacy": entry["privacy"], "chunks": chunks, "version": 1}
+        else:
+            # Plain save_local folders only have the chunk metadata: group it into
+            # one entry per uploaded file (its hash is unknown, so a re-upload is re-parsed)
+            for position, doc in enumerate(docs):
+                owner, file_name = doc.metadata.get("owner"), doc.metadata.get("source")
+                if owner is None or file_name is None:
+                    continue
+                entry = sources.setdefault(f"{owner}/{file_name}", {"file_hash": None, "chunks": {}, "version": 1})
+                # A file uploaded twice added its chunks twice: the newest copy wins
+                chunk_hash = chunk_id(owner, file_name, doc.page_content)
+                if chunk_hash in entry["chunks"]:
+                    tombstones.append(entry["chunks"][chunk_hash])
+                entry["chunks"][chunk_hash] = position
+                entry["privacy"] = doc.metadata.get("privacy", "private")
+
+        name = "seg_000001"
+        self.chunks.add(ids.tolist(), docs)
+        segment = self._write_segment(Segment(name, index, ids, *owner_codes(docs), sources, tombstones))
+        manifest = {"version": 1, "next_segment": 2, "next_vector_id": int(index.ntotal), "segments": [name]}
+        self._write_manifest(manifest)
+        self.manifest = manifest
+        self._set_segments([segment])
+        self._remove_legacy_files()
+        print(f"✅ Migrated legacy index ({index.ntotal} vectors) to segmented format.")
+
+    # --- WRITING ---
+    def new_builder(self):
+        """SegmentBuilder for one ingestion, spilling its chunks under the store folder."""
+        builds_root = os.path.join(self.path, BUILDS_DIR)
+        os.makedirs(builds_root, exist_ok=True)
+        return SegmentBuilder(tempfile.mkdtemp(dir=builds_root))
+
+    def _write_segment(self, segment):
+        """Writes `segment` and returns it re-opened from disk (memory-mapped)."""
+        # Build in a temp folder and rename, so a segment folder is either complete or absent
+        segments_root = os.path.join(self.path, SEGMENTS_DIR)
+        os.makedirs(segments_root, exist_ok=True)
+        tmp_dir = os.path.join(segments_root, f".tmp-{segment.name}")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        segment.save(tmp_dir)
+        os.rename(tmp_dir, self._segment_dir(segment.name))
+        _fsync_dir(segments_root)
+        return Segment.load(self._segment_dir(segment.name), segment.name)
+
+    def _write_manifest(self, manifest):
+        manifest_path = os.path.join(self.path, MANIFEST_FILE)
+        tmp_path = manifest_path + ".tmp"
+        _write_json(tmp_path, manifest)
+        os.replace(tmp_path, manifest_path)
+        _fsync_dir(self.path)
+        # Our own publish must not look like another process's to refresh()
+        self._marker = self._manifest_marker()
+
+    def commit(self, builder, sources, tombstones=()):
+        """
+        Persists one ingestion as new segments (one per builder part) and
+        publishes them together. `sources` are the manifest entries of the
+        ingested files; chunks with a vector id of None are the ones in
+        `builder` and get their ids here. The entries and `tombstones` are
+        recorded in the last of the new segments.
+        Returns the new store version.
+        """
+        with self._locked():
+            # Another process may have published since; ids and names continue from its manifest
+            self.refresh()
+            manifest = dict(self.manifest)
+            version = manifest["version"] + 1
+            start = manifest["next_vector_id"]
+            ids = np.arange(start, start + len(builder), dtype=np.int64)
+
+            sources = {
+                key: dict(entry, chunks=dict(entry["chunks"]), version=version)
+                for key, entry in sources.items()
+            }
+            for vector_id, (source_key, chunk_hash) in zip(ids.tolist(), builder.refs):
+                sources[source_key]["chunks"][chunk_hash] = vector_id
+
+            new_segments = []
+            offset = 0
+            last = builder.part_count - 1
+            for n, (index, docs) in enumerate(builder.parts()):
+                name = f"seg_{manifest['next_segment'] + n:06d}"
+                part_ids = ids[offset:offset + len(docs)]
+                offset += len(docs)
+                # Chunk rows first: until the manifest names the segment they are unreachable
+                self.chunks.add(part_ids.tolist(), docs)
+                codes, owners = owner_codes(docs)
+                part_sources, part_tombstones = (sources, tombstones) if n == last else ({}, ())
+                new_segments.append(self._write_segment(
+                    Segment(name, index, part_ids, codes, owners, part_sources, part_tombstones)
+                ))
+
+            manifest.update(
+                version=version,
+                next_segment=manifest["next_segment"] + len(new_segments),
+                next_vector_id=start + len(builder),
+                segments=manifest["segments"] + [seg.name for seg in new_segments],
+            )
+            self._write_manifest(manifest)
+            self.manifest = manifest
+
+            # Publish in memory: readers still holding the old snapshot are unaffected
+            old = self._snapshot
+            segments = list(old.segments)
+            all_tombstones = old.tombstones
+            new_tombstones = set(tombstones) - old.tombstones
+            if new_tombstones:
+                all_tombstones = old.tombstones | new_tombstones
+                new_ids = np.fromiter(new_tombstones, dtype=np.int64)
+                segments = [
+                    seg.with_tombstones(all_tombstones) if np.isin(seg.ids, new_ids).any() else seg
+                    for seg in segments
+                ]
+            for segment in new_segments:
+                segment.set_dead(all_tombstones)
+                segment._sources = {}
+            new_segments[-1]._sources = sources
+            merged_sources = None
+            if old._sources is not None:
+                merged_sources = {**old._sources, **sources}
+                for key in [key for key, entry in sources.items() if entry.get("deleted")]:
+                    del merged_sources[key]
+            self._snapshot = Snapshot(version, segments + new_segments, all_tombstones, merged_sources, manifest["next_vector_id"])
+
+        self.maybe_compact()
+        return version
+
+    def delete_sources(self, source_keys):
+        """
+        Removes whole files ("owner/file name" keys): their chunks are
+        tombstoned and a deletion marker replaces their manifest entry, in one
+        small commit. Nothing is re-embedded or rewritten, so the cost does
+        not depend on the index size; space is reclaimed by compaction.
+        Returns {source_key: chunks deleted} for the keys that existed.
+        """
+        with self._locked():
+            self.refresh()
+            found = {key: self.sources[key] for key in source_keys if key in self.sources}
+            if not found:
+                return {}
+            tombstones = [v for entry in found.values() for v in entry["chunks"].values() if v is not None]
+            markers = {
+                key: {"file_hash": None, "privacy": entry["privacy"], "chunks": {}, "deleted": True}
+                for key, entry in found.items()
+            }
+            self.commit(SegmentBuilder(), markers, tombstones)
+        return {key: len(entry["chunks"]) for key, entry in found.items()}
+
+    # --- COMPACTION ---
+    def _needs_reindex(self, seg):
+        wanted = resolve_index_type(seg.live, self.index_type)
+        return seg.index is not None and wanted != "flat" and seg.index_type != wanted
+
+    def _pick_victims(self):
+        segments = self.segments
+        if len(segments) > self.max_segments:
+            # Merge the segments with the fewest live vectors
+            return sorted(segments, key=lambda s: s.live)[:len(segments) - self.max_segments + 1]
+        # Incremental: the segment with the most deleted vectors is rewritten without them
+        for seg in sorted(segments, key=lambda s: len(s.ids) - s.live, reverse=True):
+            if len(seg.ids) and (len(seg.ids) - seg.live) / len(seg.ids) >= COMPACT_DEAD_RATIO:
+                return [seg]
+        # A segment that has grown past the ANN threshold is rebuilt on its own
+        for seg in sorted(segments, key=lambda s: s.live, reverse=True):
+            if self._needs_reindex(seg):
+                return [seg]
+        return []
+
+    def maybe_compact(self):
+        """Starts a background merge/reindex when one is due."""
+        if self._compacting or not self._pick_victims():
+            return
+        self._compacting = True
+        threading.Thread(target=self._compact_in_background, daemon=True).start()
+
+    def _compact_in_background(self):
+        try:
+            self.compact()
+        except Exception as e:
+            print(f"⚠️ Compaction failed: {e}")
+        finally:
+            self._compacting = False
+
+    def compact(self, victims=None, threshold=None):
+        """
+        Merges segments (by default the ones picked by _pick_victims) into one,
+        built with the configured index type.
+        """
+        victims = self._pick_victims() if victims is None else victims
+        if not victims:
+            return
+
+        # Merging happens outside the write lock so ingestion is never blocked by it
+        merged = merge_segments(None, victims, set(self.tombstones), self.index_type, threshold)
+
+        with self._locked():
+            self.refresh()
+            victim_names = {seg.name for seg in victims}
+            if not victim_names <= {seg.name for seg in self.segments}:
+                # Another process compacted some of them first
+                return
+            name = f"seg_{self.manifest['next_segment']:06d}"
+            merged.name = name
+            remaining = [seg for seg in self.segments if seg.name not in victim_names]
+            # Only tombstones of vectors that still exist are worth persisting
+            merged.tombstones = prune_tombstones(merged.tombstones, remaining)
+            merged = self._write_segment(merged)
+
+            # Rows of dropped vectors go first: once their ids leave the tombstone set,
+            # a lexical search must not be able to find them any more
+            dropped = set(np.concatenate([seg.ids for seg in victims]).tolist()) - set(merged.ids.tolist())
+            self.chunks.delete(dropped)
+
+            manifest = dict(
+                self.manifest,
+                next_segment=self.manifest["next_segment"] + 1,
+                segments=[seg.name for seg in remaining] + [name],
+            )
+            self._write_manifest(manifest)
+            self.manifest = manifest
+
+            old = self._snapshot
+            tombstones = old.tombstones - dropped
+            merged.set_dead(tombstones)
+            # Same version: compaction changes the layout, not the searchable content
+            self._snapshot = Snapshot(old.version, remaining + [merged], tombstones, old._sources, old.next_vector_id)
+
+        for seg_name in victim_names:
+            shutil.rmtree(self._segment_dir(seg_name), ignore_errors=True)
+        print(f"🧹 Compacted {len(victims)} segments into {name} ({merged.index_type}).")
+
+    def reindex(self, index_type):
+        """Merges the whole store into one segment with the given index type, whatever its size."""
+        self.index_type = index_type
+        if self.segments:
+            self.compact(victims=list(self.segments), threshold=0)
+
+    # --- READING ---
+    # Every read takes an optional `snapshot`; a caller doing several reads for
+    # one request passes the same one so they all see the same version.
+    def access_scope(self, username, snapshot=None):
+        """
+        Names the set of documents `username` can see: every user without
+        private documents sees exactly the public ones (scope None).
+        """
+        return username if any(username in seg._owners for seg in self._snap(snapshot).segments) else None
+
+    def reconstruct(self, vector_ids, snapshot=None):
+        """Returns the stored vectors for `vector_ids` (in that order)."""
+        wanted = np.asarray(vector_ids, dtype=np.int64)
+        found = {}
+        for seg in self._snap(snapshot).segments:
+            if seg.index is None:
+                continue
+            positions = np.flatnonzero(np.isin(seg.ids, wanted))
+            if len(positions):
+                for vector_id, vector in zip(seg.ids[positions].tolist(), seg.get_vectors(positions)):
+                    found[vector_id] = vector
+        return np.asarray([found[int(v)] for v in wanted], dtype=np.float32)
+
+    def _search_rows(self, query_matrix, username, k, snapshot):
+        """(distances, ids) of the best k hits of every query row across all segments, -1 padded."""
+        all_distances, all_ids = [], []
+        for seg in self._snap(snapshot).segments:
+            if seg.index is None:
+                continue
+            result = seg.search(query_matrix, username, k, self.nprobe, self.ef_search)
+            if result is None:
+                continue
+            distances, positions = result
+            all_distances.append(distances)
+            all_ids.append(np.where(positions >= 0, np.asarray(seg.ids)[positions], -1))
+
+        if not all_distances:
+            return None, None
+
+        distances = np.concatenate(all_distances, axis=1)
+        ids = np.concatenate(all_ids, axis=1)
+
+        # Best k per query row across all segments
+        best = np.argsort(distances, axis=1, kind="stable")[:, :k]
+        return np.take_along_axis(distances, best, axis=1), np.take_along_axis(ids, best, axis=1)
+
+    @staticmethod
+    def _union(distances, ids):
+        """Hits of several rows as (vector_ids, distances), each vector once with its smallest distance, best first."""
+        if distances is None:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        distances, ids = distances.ravel(), ids.ravel()
+        valid = ids >= 0
+        distances, ids = distances[valid], ids[valid]
+
+        # Sort by distance, then keep the first (= closest) occurrence of every vector id
+        order = np.argsort(distances, kind="stable")
+        _, first = np.unique(ids[order], return_index=True)
+        keep = order[np.sort(first)]
+        return ids[keep], distances[keep]
+
+    def search_ids(self, query_matrix, username, k=4, snapshot=None):
+        """
+        Searches every segment for the query rows, restricted to the live
+        vectors `username` can access. Each row keeps its best k hits overall;
+        the union is returned as (vector_ids, distances) arrays, each vector
+        once with its smallest distance, best first.
+        """
+        return self._union(*self._search_rows(query_matrix, username, k, snapshot))
+
+    def search_ids_batch(self, query_matrices, username, k=4, snapshot=None):
+        """
+        search_ids() for several independent requests with the same access,
+        run as one FAISS search per segment. Returns one (vector_ids, distances) per matrix.
+        """
+        distances, ids = self._search_rows(np.concatenate(query_matrices), username, k, snapshot)
+        results, row = [], 0
+        for matrix in query_matrices:
+            rows = slice(row, row + len(matrix))
+            row += len(matrix)
+            if distances is None:
+                results.append(self._union(None, None))
+            else:
+                results.append(self._union(distances[rows], ids[rows]))
+        return results
+
+    def search(self, query_matrix, username, k=4, snapshot=None):
+        """search_ids() resolved to [(Document, distance)], best first."""
+        ids, distances = self.search_ids(query_matrix, username, k, snapshot)
+        return self.resolve(ids, distances)
+
+    def resolve(self, vector_ids, distances):
+        """Pairs vector ids with their chunk Documents (one batched lookup)."""
+        docs = self.chunks.get(list(vector_ids))
+        return [
+            (docs[int(vector_id)], float(distance))
+            for vector_id, distance in zip(vector_ids, distances)
+            if int(vector_id) in docs
+        ]
+
+    def lexical_search(self, text, username, k=8, snapshot=None):
+        """BM25 hits [(vector_id, score)] among the live chunks `username` can see, best first."""
+        snap = self._snap(snapshot)
+        # Tombstoned chunks keep their rows until compaction, so ask for a few extra
+        hits = self.chunks.lexical_search(text, username, limit=k + min(len(snap.tombstones), 4 * k))
+        return [
+            (vector_id, score) for vector_id, score in hits
+            # Rows of an ingestion published after `snap` are skipped too
+            if vector_id not in snap.tombstones and vector_id < snap.next_vector_id
+        ][:k]
+
+    def distances(self, query_vector, vector_ids, snapshot=None):
+        """Squared L2 distances (the FAISS metric) from `query_vector` to stored vectors."""
+        if not len(vector_ids):
+            return np.empty(0, dtype=np.float32)
+        vectors = self.reconstruct(vector_ids, snapshot)
+        return ((vectors - np.asarray(query_vector, dtype=np.float32)) ** 2).sum(axis=1)
+
+    def recall_report(self, queries=None, k=10, nprobes=(1, 4, 16, 64), ef_searches=(16, 32, 64, 128), sample=200):
+        """
+        Measures recall@k and latency of every approximate segment against an
+        exact search over its raw vectors, for a range of nprobe / efSearch.
+        `queries` defaults to a sample of stored vectors.
+        Returns one dict per (segment, setting).
+        """
+        rows = []
+        for seg in self.segments:
+            if seg.index_type == "flat" or not len(seg.ids):
+                continue
+            if queries is None:
+                picks = np.random.default_rng(0).choice(len(seg.ids), min(sample, len(seg.ids)), replace=False)
+                seg_queries = seg.get_vectors(np.sort(picks))
+            else:
+                seg_queries = np.asarray(queries, dtype=np.float32)
+
+            start = time.perf_counter()
+            _, exact = faiss.knn(seg_queries, np.ascontiguousarray(seg.vectors, dtype=np.float32), k)
+            exact_ms = (time.perf_counter() - start) * 1000 / len(seg_queries)
+
+            if seg.index_type == "hnsw":
+                settings = [("efSearch", v, faiss.SearchParametersHNSW(efSearch=v)) for v in ef_searches]
+            else:
+                settings = [("nprobe", v, faiss.SearchParametersIVF(nprobe=v)) for v in nprobes]
+
+            for knob, value, params in settings:
+                start = time.perf_counter()
+                _, found = seg.index.search(seg_queries, k, params=params)
+                ann_ms = (time.perf_counter() - start) * 1000 / len(seg_queries)
+                hits = sum(len(set(f[f >= 0]) & set(e)) for f, e in zip(found, exact))
+                rows.append({
+                    "segment": seg.name,
+                    "index_type": seg.index_type,
+                    "vectors": len(seg.ids),
+                    knob: value,
+                    f"recall@{k}": round(hits / (len(seg_queries) * k), 4),
+                    "ann_ms_per_query": round(ann_ms, 4),
+                    "exact_ms_per_query": round(exact_ms, 4),
+                })
+        return rows